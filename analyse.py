@@ -1,89 +1,51 @@
 import matplotlib.pyplot as plt
+import numpy as np
+from results import ResultsStore
 
+MOVIE = 'MAVERICK.mp4'
+MESSAGE = 314159
 
-data = open('results/MAVERICK.mp4_data.txt',"r")
+store = ResultsStore('results/store')
+# Results of the previous versions, written as text
+if len(store) == 0:
+    store.import_text('results/'+MOVIE+'_data.txt')
 
-full_data_set=[]
 
-for line in data:
-    dic = {}
-    l = line.strip().split(" ")
-    print(line)
-    dic['alpha'] = l[1]
-    dic['n_dct'] = l[2]
-    dic['encoding_time'] = l[3]
-    dic['decoding_time'] = l[4]
-    dic['message'] = l[5]
-    dic['confidence']=l[6]
-    dic['compression']=l[7]
-    full_data_set.append(dic)
+def load(*columns, compression=None):
+    """
+    Returns the arrays of [columns] for the results of MOVIE (with the compression rate [compression] if given)
+    """
+    data = store.load('movie', 'compression', *columns)
+    selected = data['movie'] == MOVIE
+    if compression is not None:
+        selected &= data['compression'] == compression
+    return [data[column][selected] for column in columns]
 
 
 def plot_correctness():
-    X_green = []
-    X_red = []
-    Y_green = []
-    Y_red = []
-    for row in full_data_set:
-        if row['message']=="314159" and row['compression']=="10":
-            X_green.append(row['alpha'])
-            Y_green.append(row['n_dct'])
-        elif row['compression']=="10":
-            X_red.append(row['alpha'])
-            Y_red.append(row['n_dct'])
-    plt.scatter(X_red,Y_red,color='red')
-    plt.scatter(X_green,Y_green,color='green')
+    alpha, n_dct, message = load('alpha', 'n_dct', 'message', compression=10)
+    correct = message == MESSAGE
+    plt.scatter(alpha[~correct],n_dct[~correct],color='red')
+    plt.scatter(alpha[correct],n_dct[correct],color='green')
     plt.title("Correctness with a compression rate of 0.1")
     plt.show()
 
 
 def plot_accuracy():
-    X_darkgreen = []
-    X_green = []
-    X_yellow = []
-    X_orange = []
-    X_red = []
-    Y_darkgreen = []
-    Y_green = []
-    Y_yellow = []
-    Y_orange = []
-    Y_red = []
+    alpha, n_dct, confidence = load('alpha', 'n_dct', 'confidence', compression=10)
+    bins = np.digitize(confidence, [10, 800, 2000, 4000], right=True)
 
-    for row in full_data_set:
-        if row['compression'] == '10':
-            if float(row['confidence']) > 4000:
-                X_darkgreen.append(row['alpha'])
-                Y_darkgreen.append(row['n_dct'])
-            elif float(row['confidence'])  > 2000:
-                X_green.append(row['alpha'])
-                Y_green.append(row['n_dct'])
-            elif float(row['confidence'])  > 800:
-                X_yellow.append(row['alpha'])
-                Y_yellow.append(row['n_dct'])
-            elif float(row['confidence'])  > 10:
-                X_orange.append(row['alpha'])
-                Y_orange.append(row['n_dct'])
-            else :
-                X_red.append(row['alpha'])
-                Y_red.append(row['n_dct'])
-    plt.scatter(X_red,Y_red,color='red')
-    plt.scatter(X_orange,Y_orange,color='orange')
-    plt.scatter(X_yellow,Y_yellow,color='yellow')
-    plt.scatter(X_green,Y_green,color='lime')
-    plt.scatter(X_darkgreen,Y_darkgreen,color='darkgreen')
+    for level, color in enumerate(['red', 'orange', 'yellow', 'lime', 'darkgreen']):
+        plt.scatter(alpha[bins == level],n_dct[bins == level],color=color)
     plt.title("Accuracy with a compression rate of 0.1")
     plt.legend(["Accuracy <= 10","Accuracy in ]10, 800]","Accuracy in ]800, 2000]","Accuracy in ]2000, 4000]","Accuracy >4000"],bbox_to_anchor=(0.5, 0.30))
     plt.show()
 
 def plot_performance():
-    x_encode = []
-    x_decode = []
-    for row in full_data_set:
-        x_encode.append(float(row['encoding_time']))
-        x_decode.append(float(row['decoding_time']))
+    x_encode, x_decode = load('encoding_time', 'decoding_time')
 
-    print(f"[Encoding time] : average = {sum(x_encode)/len(x_encode)} | minimum = {min(x_encode)} | maximum = {max(x_encode)}")
-    print(f"[Decoding time] : average = {sum(x_decode)/len(x_decode)} | minimum = {min(x_decode)} | maximum = {max(x_decode)}")
+    print(f"[Encoding time] : average = {x_encode.mean()} | minimum = {x_encode.min()} | maximum = {x_encode.max()}")
+    print(f"[Decoding time] : average = {x_decode.mean()} | minimum = {x_decode.min()} | maximum = {x_decode.max()}")
 
 def plot_transparence():
     X = [(0.05,30),(0.05,25),(0.05,20),(0.05,15),(0.1,30),(0.1,25),(0.1,20),(0.1,16),(0.1,14),(0.1,10),(0.2,30),(0.2,25),(0.2,20),(0.2,16),(0.2,14),(0.2,10),(0.2,8),(0.2,4),(0.4,25),(0.4,20),(0.4,16),(0.4,14),(0.4,10),(0.4,8),(0.4,4),(0.8,10),(0.8,8),(0.8,4),(0.8,2),(1.5,4),(1.5,2),(2,4),(2,2),(2,1)]
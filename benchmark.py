@@ -0,0 +1,200 @@
+"""
+Benchmark the watermarking on deterministic synthetic videos
+@authors : micronoyau and devilsharu
+"""
+
+import os
+import sys
+import time
+import json
+import platform
+import resource
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import av
+
+from main import *
+
+FPS = 24
+AUDIO_RATE = 44100
+
+
+def generate_clip(filename: str, width: int, height: int, duration: float, gop: int, seed: int = 0) -> int:
+    """
+    Writes a synthetic video of [duration] seconds and [width] x [height] pixels to [filename],
+    with a GOP of [gop] frames and a silent audio stream. The content only depends on [seed] :
+    smooth moving gradients with a little noise, which is closer to a movie than pure noise.
+    Returns the number of frames
+    """
+    rng = np.random.default_rng(seed)
+    n_frames = int(duration * FPS)
+
+    container = av.open(filename, mode="w")
+    video_stream = container.add_stream('libx264', FPS)
+    video_stream.width = width
+    video_stream.height = height
+    video_stream.pix_fmt = 'yuv420p'
+    video_stream.options = {'x264-params': 'keyint={0}:min-keyint={0}:scenecut=0'.format(gop)}
+    audio_stream = container.add_stream('aac', AUDIO_RATE)
+
+    y, x = np.mgrid[0:height, 0:width] / max(width, height)
+    for i in range(n_frames):
+        t = i / FPS
+        image = np.stack([np.sin(2*np.pi*(x + 0.1*t)) * np.cos(2*np.pi*(y - 0.05*t)),
+                          np.sin(2*np.pi*(x*y + 0.2*t)),
+                          np.cos(2*np.pi*(x - y + 0.15*t))], axis=-1)
+        image = 128 + 80*image + rng.normal(0, 4, image.shape)
+        frame = av.VideoFrame.from_ndarray(np.clip(image, 0, 255).astype(np.uint8), format='rgb24')
+        for packet in video_stream.encode(frame):
+            container.mux(packet)
+
+    samples = np.zeros((1, 1024), np.float32)
+    for i in range(int(duration * AUDIO_RATE) // 1024):
+        frame = av.AudioFrame.from_ndarray(samples, format='fltp', layout='mono')
+        frame.sample_rate = AUDIO_RATE
+        for packet in audio_stream.encode(frame):
+            container.mux(packet)
+
+    for stream in (video_stream, audio_stream):
+        for packet in stream.encode():
+            container.mux(packet)
+    container.close()
+
+    return n_frames
+
+
+def timed(function, *args, **kwargs):
+    """
+    Runs [function] and returns its (result, duration in seconds, peak RSS of the process in MB)
+    """
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    duration = time.perf_counter() - start
+    # Kilobytes on Linux, bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2**20 if sys.platform == 'darwin' else 2**10)
+    return result, duration, peak_rss
+
+
+def timed_in_process(function, *args, **kwargs):
+    """
+    Same as timed, in a new process : the peak RSS is the one of [function] only
+    """
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(timed, function, *args, **kwargs).result()
+
+
+def bench_compute_G(n_dct: int, n_keys: int = 1000) -> float:
+    """
+    Returns the duration of computing the patterns of [n_keys] keys, without the cache
+    """
+    compute_G.cache_clear()
+    start = time.perf_counter()
+    for key in range(n_keys):
+        compute_G(key, n_dct)
+    return time.perf_counter() - start
+
+
+def bench_watermark_step(movie_filename: str, n_dct: int, alpha: float, luma: bool, n_frames: int = 64) -> tuple:
+    """
+    Returns the duration of watermarking the first [n_frames] decoded frames of [movie_filename]
+    and the number of frames watermarked,
+    without decoding nor encoding
+    """
+    container, video_stream, audio_stream = open_existing_movie(movie_filename)
+    frames = [frame for frame, i in zip(container.decode(video_stream), range(n_frames))]
+    container.close()
+
+    watermarker = get_watermarker(0, 42, n_dct, alpha, luma)
+    start = time.perf_counter()
+    for batch in batched(frames, watermarker.batch_size):
+        watermarker.release(watermarker(batch))
+    return time.perf_counter() - start, len(frames)
+
+
+def bit_error_rate(msg: bytes, decoded: BitArray) -> float:
+    """
+    Returns the proportion of the bit periods of [decoded] (as returned by decode_AB) which differ
+    from the bits written by encode_AB for [msg]
+    """
+    bs = ConstBitStream(msg)[::-1]
+    expected = [read_symbol(bs) for i in range(len(decoded))]
+    return float(np.mean([bool(bit) != bool(expected_bit) for bit, expected_bit in zip(decoded[::-1], expected)]))
+
+
+def bench_clip(width: int, height: int, duration: float, gop: int, n_dct: int, alpha: float, freq: float, luma: bool, message: int) -> list:
+    """
+    Benchmarks every stage on a synthetic clip. Returns one result per stage
+    """
+    clip = {'width': width, 'height': height, 'duration': duration, 'gop': gop}
+    results = []
+
+    def result(stage, frames, duration, peak_rss=None, **extra):
+        results.append(dict(clip=clip, stage=stage, frames=frames, seconds=duration,
+                            frames_per_second=frames / duration if frames else None, peak_rss_mb=peak_rss, **extra))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        source, A, B, AB = (os.path.join(tmp_dir, name) for name in ('source.mp4', 'A.mp4', 'B.mp4', 'AB.mp4'))
+        n_frames = generate_clip(source, width, height, duration, gop)
+
+        n_keys = 1000
+        result('compute_G', None, bench_compute_G(n_dct, n_keys), keys=n_keys)
+
+        duration, frames = bench_watermark_step(source, n_dct, alpha, luma)
+        result('watermark_step', frames, duration)
+
+        _, duration, peak_rss = timed_in_process(encode_watermark, 0, 42, n_dct, alpha, source, A, luma=luma)
+        result('encode_watermark', n_frames, duration, peak_rss)
+        encode_watermark(1, 42, n_dct, alpha, source, B, luma=luma)
+
+        msg = message_to_bytes(message)
+        _, duration, peak_rss = timed_in_process(encode_AB, msg, A, B, AB, freq)
+        result('encode_AB', n_frames, duration, peak_rss)
+
+        (decoded, confidence), duration, peak_rss = timed_in_process(decode_AB, 42, n_dct, AB, freq, luma=luma)
+        result('decode_AB', n_frames, duration, peak_rss, confidence=float(confidence), bit_error_rate=bit_error_rate(msg, decoded))
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the watermarking on synthetic videos')
+    parser.add_argument('-r', '--resolutions', type=str, nargs='+', default=['320x180', '640x360', '1280x720'], help='Resolutions (WIDTHxHEIGHT)')
+    parser.add_argument('-d', '--durations', type=float, nargs='+', default=[10], help='Durations (in seconds)')
+    parser.add_argument('-g', '--gops', type=int, nargs='+', default=[GOP_SIZE], help='GOP sizes of the synthetic videos (in frames)')
+    parser.add_argument('-n', '--n-dct', type=int, default=10)
+    parser.add_argument('-a', '--alpha', type=float, default=1)
+    parser.add_argument('-f', '--frequency', type=float, default=1, help='Frequency of encoding')
+    parser.add_argument('-m', '--message', type=int, default=314159, help='Message (ID) to hide')
+    parser.add_argument('-l', '--luma', action='store_true', help='Watermark the luma plane instead of the RGB image')
+    parser.add_argument('-o', '--output', type=str, default='results/benchmark.json', help='Output JSON filename')
+    args = parser.parse_args()
+
+    results = []
+    for resolution in args.resolutions:
+        width, height = map(int, resolution.split('x'))
+        for duration in args.durations:
+            for gop in args.gops:
+                results += bench_clip(width, height, duration, gop, args.n_dct, args.alpha, args.frequency, args.luma, args.message)
+
+    report = {
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'av': av.__version__,
+            'numpy': np.__version__,
+        },
+        'parameters': {'n_dct': args.n_dct, 'alpha': args.alpha, 'frequency': args.frequency, 'message': args.message, 'luma': args.luma},
+        'results': results,
+    }
+
+    with open(args.output, 'w') as output:
+        json.dump(report, output, indent=2)
+
+    for result in results:
+        print("{clip[width]}x{clip[height]} {clip[duration]}s gop={clip[gop]} {stage:>16} : {seconds:.3f}s".format(**result)
+              + (" ({:.1f} frames/s)".format(result['frames_per_second']) if result['frames_per_second'] else "")
+              + (" BER={}".format(result['bit_error_rate']) if 'bit_error_rate' in result else ""))
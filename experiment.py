@@ -1,9 +1,22 @@
 from main import *
+from results import ResultsStore
 from pytube import YouTube
 import os
+import glob
 import time
+import shutil
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from moviepy.editor import VideoFileClip
 
+KEY = 42
+MESSAGE = 314159
+FREQUENCY = 0.5
+ALPHAS = [0.005,0.01,0.02,0.05,0.1,0.2,0.4,0.8,1.5,2,3,4,5]
+N_DCTS = [1,2,4,8,10,14,16,20,25,30]
+COMPRESSIONS = [100,75,50,25,10] # 100 means no compression
+RESULTS_STORE = 'results/store'
+
 
 def downloadYouTube(videourl, path,tag):
 
@@ -23,9 +36,11 @@ def compress_mp4(input_file, output_file, compression_factor=0.5):
 
         video = clip
         mp3 = video.audio
+        # Next to the output, so that parallel jobs don't share it
+        mp3_file = output_file + ".mp3"
         if mp3 is not None:
-            mp3.write_audiofile("vid_audio.mp3")
-        mp3_size =  os.path.getsize("vid_audio.mp3")
+            mp3.write_audiofile(mp3_file)
+        mp3_size =  os.path.getsize(mp3_file)
         vid_size = os.path.getsize(input_file)
         duration = video.duration
 
@@ -41,46 +56,111 @@ def compress_mp4(input_file, output_file, compression_factor=0.5):
     except Exception as e:
         print(f'Error during compression: {e}')
 
-#Open the file containing the links and tags of all the trailers we need
-listOfFilm = open("movies/list.txt","r")
-
-#List already downloaded trailers
-alreadyDownloaded = os.listdir("movies/")
-
-for links in listOfFilm:
-    link = links.strip().split(" ")[0]
-    tag = links.strip().split(" ")[1]
-    if tag+".mp4" not in alreadyDownloaded:
-        downloadYouTube(link, 'movies/',tag)
-
-#Update list of downloaded movies
-alreadyDownloaded = os.listdir("movies/")
-print(alreadyDownloaded)
-
-
-for movie in alreadyDownloaded:
-    if movie != 'list.txt':
-        dataOutput = open('results/'+movie+"_data.txt","a")
-        currMovieFile = "movies/"+movie
-        for alpha in [0.005,0.01,0.02,0.05,0.1,0.2,0.4,0.8,1.5,2,3,4,5]:
-            for n_dct in [1,2,4,8,10,14,16,20,25,30]:
-                print(f"alpha : {alpha} | n_dct : {n_dct}\n")
-                beforeTime = time.time()
-                encode_watermark(0, 42, n_dct, alpha, currMovieFile, "out/current_0.mp4")
-                encode_watermark(1, 42, n_dct, alpha, currMovieFile, "out/current_1.mp4")
-                msg = 314159
-                encode_AB(msg.to_bytes((msg//256)+1), 'out/current_0.mp4', 'out/current_1.mp4','out/current_uncompressed.mp4', 0.5)
-                middleTime = time.time()
-                encoding_time = middleTime - beforeTime
-                res,confidence = decode_AB(42, n_dct, "out/current_uncompressed.mp4", 0.5)
-                decoding_time = time.time() - middleTime
-
-                dataOutput.write(f'{movie} {alpha} {n_dct} {encoding_time} {decoding_time} {res.u} {confidence} 100\n')
-
-                for compression in [75,50,25,10]:
-                    compress_mp4('out/current_uncompressed.mp4','out/current_compressed_'+str(compression)+".mp4",compression/100)
-                    beforeDecodeTime = time.time()
-                    res,confidence = decode_AB(42, n_dct, "out/current_compressed_"+str(compression)+".mp4", 0.5)
-                    decodingCompressedTime = time.time() - beforeDecodeTime
-
-                    dataOutput.write(f'{movie} {alpha} {n_dct} {encoding_time} {decodingCompressedTime} {res.u} {confidence} {compression}\n')
\ No newline at end of file
+
+def load_done(store, movie):
+    """
+    Returns the set of (alpha, n_dct, compression) of [movie] already in the results store [store]
+    """
+    results = store.load('movie', 'alpha', 'n_dct', 'compression')
+    selected = results['movie'] == movie
+    return set(zip(results['alpha'][selected].tolist(), results['n_dct'][selected].tolist(), results['compression'][selected].tolist()))
+
+
+def run_variant(movie, alpha, n_dct, compressions, threads=1):
+    """
+    Encodes the A/B variants of [movie] for ([alpha], [n_dct]) once, then decodes the message
+    for each compression level of [compressions].
+    Every output goes in a directory of its own, removed at the end, so that jobs can run in parallel.
+    Each job uses [threads] threads to watermark, encode and decode, so that parallel jobs don't oversubscribe the CPUs.
+    Returns the result rows (see results.COLUMNS)
+    """
+    currMovieFile = "movies/"+movie
+    out_dir = f"out/{movie}_{alpha}_{n_dct}"
+    os.makedirs(out_dir, exist_ok=True)
+    rows = []
+
+    print(f"alpha : {alpha} | n_dct : {n_dct}\n")
+    encoder, decoder = encoder_profile(threads=threads), {'thread_count': threads}
+    beforeTime = time.time()
+    encode_watermark(0, KEY, n_dct, alpha, currMovieFile, out_dir+"/current_0.mp4", workers=threads, encoder=encoder, decoder=decoder)
+    encode_watermark(1, KEY, n_dct, alpha, currMovieFile, out_dir+"/current_1.mp4", workers=threads, encoder=encoder, decoder=decoder)
+    encode_AB(message_to_bytes(MESSAGE), out_dir+'/current_0.mp4', out_dir+'/current_1.mp4', out_dir+'/current_uncompressed.mp4', FREQUENCY,
+              encoder=encoder, decoder=decoder)
+    encoding_time = time.time() - beforeTime
+
+    for compression in compressions:
+        if compression == 100:
+            current_file = out_dir+"/current_uncompressed.mp4"
+        else:
+            current_file = out_dir+"/current_compressed_"+str(compression)+".mp4"
+            compress_mp4(out_dir+'/current_uncompressed.mp4', current_file, compression/100)
+
+        beforeDecodeTime = time.time()
+        res,confidence = decode_AB(KEY, n_dct, current_file, FREQUENCY, workers=threads, decoder=decoder)
+        decoding_time = time.time() - beforeDecodeTime
+
+        rows.append((movie, alpha, n_dct, encoding_time, decoding_time, res.u % 2**64, confidence, compression))
+
+    shutil.rmtree(out_dir)
+    return rows
+
+
+def run_sweep(movie, store, processes=None):
+    """
+    Runs the (alpha, n_dct, compression) grid on [movie] with a pool of [processes] processes
+    (by default, one per CPU), one job per (alpha, n_dct).
+    The grid points already in the results store [store] are skipped, and the results of each job
+    are appended as soon as it is done, so an interrupted sweep can be resumed.
+    A failed job is reported, and the sweep goes on with the others
+    """
+    done = load_done(store, movie)
+
+    jobs = []
+    for alpha in ALPHAS:
+        for n_dct in N_DCTS:
+            compressions = [compression for compression in COMPRESSIONS if (alpha, n_dct, compression) not in done]
+            if compressions:
+                jobs.append((movie, alpha, n_dct, compressions))
+
+    print(f"{movie} : {len(jobs)} jobs to run")
+
+    with ProcessPoolExecutor(processes) as executor:
+        futures = {executor.submit(run_variant, *job): job for job in jobs}
+        for future in as_completed(futures):
+            movie, alpha, n_dct, compressions = futures[future]
+            try:
+                store.append(future.result())
+            except Exception as e:
+                print(f'Error on {movie} (alpha : {alpha} | n_dct : {n_dct} | compressions : {compressions}): {e}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the watermarking over a grid of parameters')
+    parser.add_argument('-p', '--processes', type=int, help='Number of jobs run in parallel (default : one per CPU)')
+    args = parser.parse_args()
+
+    store = ResultsStore(RESULTS_STORE)
+    # Results of the previous versions, written as text
+    if len(store) == 0:
+        for text_filename in glob.glob('results/*_data.txt'):
+            store.import_text(text_filename)
+
+    #Open the file containing the links and tags of all the trailers we need
+    listOfFilm = open("movies/list.txt","r")
+
+    #List already downloaded trailers
+    alreadyDownloaded = os.listdir("movies/")
+
+    for links in listOfFilm:
+        link = links.strip().split(" ")[0]
+        tag = links.strip().split(" ")[1]
+        if tag+".mp4" not in alreadyDownloaded:
+            downloadYouTube(link, 'movies/',tag)
+
+    #Update list of downloaded movies
+    alreadyDownloaded = os.listdir("movies/")
+    print(alreadyDownloaded)
+
+    for movie in alreadyDownloaded:
+        if movie != 'list.txt':
+            run_sweep(movie, store, args.processes)
@@ -4,12 +4,24 @@ Watermark videos with unique ID using spread spectrum watermarking
 """
 
 import sys
+import os
+import tempfile
+import heapq
+import threading
+import queue
+import time
+import json
+import hashlib
+import zlib
+import shutil
 from typing import Callable
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from collections import deque
 
-# Video & image processing
-import cv2
+# Video processing
 import av
-from PIL import Image
 
 # Math
 import numpy as np
@@ -25,57 +37,336 @@ import argparse
 
 CHANNEL = 0 # For test purposes
 
+# Fixed GOP size of the created videos (in frames)
+GOP_SIZE = 24
 
-def compute_G(key: int, n_dct: int) -> np.array:
+# Number of frames processed at once by BatchWatermarker and BatchCorrelator
+FRAME_BATCH_SIZE = 8
+
+# Encoder options of the created videos
+X264_PARAMS = 'keyint={0}:min-keyint={0}:scenecut=0'.format(GOP_SIZE)
+
+# Default video encoder of the created videos
+VIDEO_CODEC = 'libx264'
+
+# Encoder settings (see create_movie_from) : 'fast' for the A/B assembly, 'quality' for the masters.
+# Settings which are not given are left to the defaults of the encoder
+ENCODER_PROFILES = {
+    'default': {},
+    'fast': {'preset': 'veryfast', 'crf': 20, 'thread_type': 'FRAME', 'lookahead': 10},
+    'quality': {'preset': 'slow', 'crf': 16, 'lookahead': 60},
+}
+
+# Default maximum size of a MasterCache (in bytes)
+MASTER_CACHE_SIZE = 50 * 2**30
+
+# Masters of a MasterCache used in the last MASTER_GRACE_PERIOD seconds are never evicted,
+# since other jobs may still be reading them
+MASTER_GRACE_PERIOD = 3600
+
+# Maximum number of items (packets or batches of frames) waiting between the stages of run_pipeline
+QUEUE_DEPTH = 4
+
+# Maximum duration of the packets kept by PacketIterator to reorder the streams (in seconds) :
+# past it, a stream which ended early (or is badly interleaved) no longer holds back the others
+REORDER_WINDOW = 10
+
+# Size of the checksum appended to the messages by message_to_bytes (in bytes)
+CHECKSUM_BYTES = 1
+
+# Default minimum confidence of every bit for decode_AB_incremental to stop
+DECODE_MARGIN = 4.0
+
+# Interval between two scans of a directory of segments (in seconds)
+SEGMENT_POLL_INTERVAL = 0.2
+
+# Container format and options of the segments, by extension (self-contained MPEG-TS or fragmented MP4 files)
+SEGMENT_FORMATS = {
+    '.ts': ('mpegts', {}),
+    '.mp4': ('mp4', {'movflags': 'frag_keyframe+empty_moov+default_base_moof'}),
+}
+
+# File created in a directory of segments once the last segment is written
+END_OF_STREAM = 'END'
+
+# Pixel formats whose Y plane can be processed directly
+LUMA_FORMATS = ('yuv420p', 'yuvj420p', 'yuv422p', 'yuvj422p', 'yuv444p', 'yuvj444p')
+
+
+class Profiler:
+    """
+    Cumulative time, number of calls and number of frames of each stage of the processing
+    (summed over all threads), and bytes read and written
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.seconds = {}
+        self.calls = {}
+        self.frames = {}
+        self.bytes = {'read': 0, 'written': 0}
+
+
+    @contextmanager
+    def stage(self, name: str, frames: int = 0):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start, frames)
+
+
+    def add(self, name: str, seconds: float, frames: int = 0, calls: int = 1) -> None:
+        with self.lock:
+            self.seconds[name] = self.seconds.get(name, 0) + seconds
+            self.calls[name] = self.calls.get(name, 0) + calls
+            self.frames[name] = self.frames.get(name, 0) + frames
+
+
+    def add_bytes(self, direction: str, n: int) -> None:
+        with self.lock:
+            self.bytes[direction] += n
+
+
+    def summary(self) -> str:
+        """
+        Returns the stages as a table, slowest first
+        """
+        lines = ['{:<20} {:>10} {:>10} {:>10} {:>12}'.format('stage', 'seconds', 'calls', 'frames', 'frames/s')]
+        for name in sorted(self.seconds, key=self.seconds.get, reverse=True):
+            fps = self.frames[name] / self.seconds[name] if self.frames[name] and self.seconds[name] else ''
+            lines.append('{:<20} {:>10.3f} {:>10} {:>10} {:>12}'.format(name, self.seconds[name], self.calls[name], self.frames[name],
+                                                                        '{:.1f}'.format(fps) if fps else ''))
+        lines.append('bytes read : {read}, bytes written : {written}'.format(**self.bytes))
+        return '\n'.join(lines)
+
+
+    def to_json(self) -> str:
+        stages = {name: {'seconds': self.seconds[name], 'calls': self.calls[name], 'frames': self.frames[name]} for name in self.seconds}
+        return json.dumps({'stages': stages, 'bytes': self.bytes}, indent=2)
+
+
+    def to_prometheus(self) -> str:
+        """
+        Returns the metrics in the Prometheus text format
+        """
+        lines = []
+        for metric, values, help in (('nutflex_stage_seconds_total', self.seconds, 'Cumulative time spent in the stage'),
+                                     ('nutflex_stage_calls_total', self.calls, 'Number of calls of the stage'),
+                                     ('nutflex_stage_frames_total', self.frames, 'Number of frames processed by the stage')):
+            lines += ['# HELP {} {}'.format(metric, help), '# TYPE {} counter'.format(metric)]
+            lines += ['{}{{stage="{}"}} {}'.format(metric, name, value) for name, value in values.items()]
+        lines += ['# HELP nutflex_bytes_total Bytes of packets read and written', '# TYPE nutflex_bytes_total counter']
+        lines += ['nutflex_bytes_total{{direction="{}"}} {}'.format(direction, value) for direction, value in self.bytes.items()]
+        return '\n'.join(lines) + '\n'
+
+
+# Profiler of the current run, None when profiling is disabled
+PROFILER = None
+NO_STAGE = nullcontext()
+
+
+def enable_profiling() -> Profiler:
+    """
+    Enables profiling (see stage) and returns the profiler collecting the metrics
+    """
+    global PROFILER
+    PROFILER = Profiler()
+    return PROFILER
+
+
+def stage(name: str, frames: int = 0):
+    """
+    Context manager measuring a stage [name] processing [frames] frames, if profiling is enabled
+    """
+    return PROFILER.stage(name, frames) if PROFILER else NO_STAGE
+
+
+def profiled(name: str, iterable, frames: bool = False):
+    """
+    Returns [iterable], measuring the time taken by each step of the iteration as the stage [name]
+    (as a frame if [frames]) if profiling is enabled
+    """
+    if PROFILER is None:
+        return iterable
+
+    def iterate(profiler):
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            profiler.add(name, time.perf_counter() - start, int(frames))
+            yield item
+
+    return iterate(PROFILER)
+
+
+def decode_packet(packet) -> list:
+    """
+    Returns the frames decoded from [packet], measured as the stage decode if profiling is enabled
+    """
+    if PROFILER is None:
+        return packet.decode()
+
+    start = time.perf_counter()
+    frames = packet.decode()
+    PROFILER.add('decode', time.perf_counter() - start, len(frames))
+    return frames
+
+
+def flush_decoder(video_stream) -> list:
+    """
+    Returns the frames still buffered by the decoder of [video_stream] at the end of the stream
+    (frames delayed by the reordering of B-frames)
+    """
+    with stage('decode'):
+        frames = video_stream.decode(None)
+
+    # Not set by the decoder when flushing
+    for frame in frames:
+        frame.time_base = video_stream.time_base
+    return frames
+
+
+def decode_frames(packets, video_stream):
+    """
+    Yields the frames decoded from the video [packets] of [video_stream], then the frames left in its decoder
+    """
+    for packet in packets:
+        for frame in decode_packet(packet):
+            yield frame
+
+    for frame in flush_decoder(video_stream):
+        yield frame
+
+
+def count_bytes(direction: str, packets) -> None:
+    """
+    Counts the size of [packets] as bytes read or written, if profiling is enabled
+    """
+    if PROFILER:
+        PROFILER.add_bytes(direction, sum(packet.size for packet in packets))
+
+
+@lru_cache(maxsize=256)
+def compute_G(key: int, n_dct: int, legacy: bool = True) -> np.array:
     """
     Derive a matrix from a secret key [key]
     Since only the DCT coefficients are watermarked, we need to specify [n_dct]
     to specify the size of the encoded vector (n = n_dct*n_dct).
+    The key seeds its own generator, so the global numpy RNG is left untouched :
+    if [legacy], the same legacy generator as np.random.seed, which gives the patterns
+    of the existing keys, otherwise a np.random.Generator (different patterns)
     """
-    # Seed with key
-    np.random.seed(key)
-    return 2*np.random.randint(2, size=(n_dct*n_dct))-1
+    if legacy:
+        rng = np.random.RandomState(key)
+        G = 2*rng.randint(2, size=(n_dct*n_dct))-1
+    else:
+        rng = np.random.default_rng(key)
+        G = 2*rng.integers(2, size=(n_dct*n_dct))-1
+
+    G = G.astype(np.float32)
+    # Shared between calls
+    G.flags.writeable = False
+    return G
 
 
-def get_middle_coefs_slice(array_dct: np.array, n_dct: int):
+@lru_cache(maxsize=256)
+def compute_watermark(symbol: bool, key: int, n_dct: int, alpha: float, legacy: bool = True) -> np.array:
     """
-    Returns a slice of the middle DCT coefficients
+    Returns the watermark of symbol [symbol] for the key [key], i.e. alpha * G (or -alpha * G)
+    as a [n_dct] x [n_dct] square of middle DCT coefficients
     """
-    # Consider only middle coefficients
-    arr_sz = array_dct.shape
-    midx, midy = arr_sz[0]//2, arr_sz[1]//2
-    return array_dct[midx-(n_dct//2):midx+(n_dct - n_dct//2), midy-(n_dct//2):midy+(n_dct - n_dct//2)]
+    G = compute_G(key, n_dct, legacy)
+    w = np.reshape(np.float32(alpha) * (G if symbol else -G), (n_dct,n_dct))
+    # Shared between calls
+    w.flags.writeable = False
+    return w
 
 
-def open_existing_movie(movie_filename: str):
+@lru_cache(maxsize=None)
+def middle_dct_basis(size: int, n_dct: int) -> np.array:
     """
-    Returns video and audio packets
+    Returns the [n_dct] rows of the orthonormal DCT-II matrix of size [size]
+    corresponding to the [n_dct] middle coefficients
     """
-    # Opens the stream and packets for video
-    container = av.open(movie_filename)
-    video_stream = container.streams.video[0]
-    video_packets = list(container.demux(video_stream))
+    mid = size//2
+    k = np.arange(mid-(n_dct//2), mid+(n_dct - n_dct//2))[:,None]
+    n = np.arange(size)[None,:]
+    basis = np.sqrt(2/size) * np.cos(np.pi * (2*n+1) * k / (2*size))
+    basis[k[:,0] == 0] = np.sqrt(1/size)
+    # Shared between calls
+    basis.flags.writeable = False
+    return basis
+
+
+def get_middle_coefs_pattern(shape: tuple, w: np.array) -> np.array:
+    """
+    Spatial contribution of the middle DCT coefficients [w] for an image of size [shape],
+    i.e. the inverse orthonormal DCT-II of a DCT which is [w] in the middle and 0 elsewhere
+    """
+    n_dct = w.shape[0]
+    rows = middle_dct_basis(shape[0], n_dct)
+    cols = middle_dct_basis(shape[1], n_dct)
+    return rows.T @ w @ cols
+
 
-    # Opens the stream and packets for audio
+def open_existing_movie(movie_filename: str, thread_type: str = None, thread_count: int = None):
+    """
+    Returns the container of [movie_filename] with its video and audio streams.
+    The video decoder uses [thread_count] threads (0 for one per CPU) of [thread_type] ('AUTO', 'FRAME' or 'SLICE'),
+    by default the ones of the decoder. With frame threading, the last frames are only given by flush_decoder
+    """
     container = av.open(movie_filename)
+    video_stream = container.streams.video[0]
     audio_stream = container.streams.audio[0]
-    audio_packets = list(container.demux(audio_stream))
 
-    return video_packets, audio_packets, video_stream, audio_stream
+    if thread_type is not None:
+        video_stream.thread_type = thread_type
+    if thread_count is not None:
+        video_stream.thread_count = thread_count
+
+    return container, video_stream, audio_stream
+
+
+def count_frames(video_stream) -> int:
+    """
+    Returns the number of frames of [video_stream], from the metadata of the container
+    (frame count, or duration of the stream / movie times frame rate)
+    """
+    if video_stream.frames:
+        return video_stream.frames
+
+    if video_stream.duration is not None:
+        duration = video_stream.duration * video_stream.time_base
+    elif video_stream.container.duration is not None:
+        duration = video_stream.container.duration / av.time_base
+    else:
+        return None
 
+    return int(duration * video_stream.average_rate)
 
-def create_movie_from(video_stream, audio_stream, output_filename: str):
+
+def create_movie_from(video_stream, audio_stream, output_filename: str, format: str = None, options: dict = None, encoder: dict = None):
     """
-    Create a video file from video and audio streams
+    Create a video file from video and audio streams.
+    If [audio_stream] is None, the created video has no audio stream.
+    [format] and [options] are given to the muxer (by default, the format is guessed from the filename).
+    The video is encoded with the settings [encoder] (see configure_encoder)
     """
+    encoder = encoder or {}
+
     # Creates a container for the output movie
-    output_container = av.open(output_filename, mode="w")
+    output_container = av.open(output_filename, mode="w", format=format, options=options or {})
 
     # Specify the video options for the created video
     codec_name = video_stream.codec_context.name
     fps = video_stream.average_rate
-    output_video_stream = output_container.add_stream('libx264', str(fps))
-    output_video_stream.options = {'x264-params': 'keyint=24:min-keyint=24:scenecut=0' }
+    output_video_stream = output_container.add_stream(encoder.get('codec', VIDEO_CODEC), str(fps))
+    configure_encoder(output_video_stream, encoder)
     output_video_stream.width = video_stream.codec_context.width
     width = video_stream.codec_context.width
     output_video_stream.height = video_stream.codec_context.height
@@ -83,209 +374,1334 @@ def create_movie_from(video_stream, audio_stream, output_filename: str):
     output_video_stream.pix_fmt = video_stream.codec_context.pix_fmt
 
     # Specify the audio options for the created video
-    output_audio_stream = output_container.add_stream(template=audio_stream)
+    output_audio_stream = None
+    if audio_stream is not None:
+        output_audio_stream = output_container.add_stream(template=audio_stream)
 
     return output_container, output_video_stream, output_audio_stream
 
 
-class VideoIterator:
+def configure_encoder(video_stream, encoder: dict) -> None:
+    """
+    Applies the settings [encoder] to the encoder of the created [video_stream] : 'codec' (VIDEO_CODEC by default),
+    'preset', 'crf' (constant quality) or 'bitrate' (in bits/s), 'threads' (0 for one per CPU),
+    'thread_type' ('FRAME' or 'SLICE') and 'lookahead' (in frames). The GOPs always have GOP_SIZE frames
+    """
+    options = {}
+    if 'preset' in encoder:
+        options['preset'] = encoder['preset']
+    if 'crf' in encoder:
+        options['crf'] = str(encoder['crf'])
+    if 'bitrate' in encoder:
+        video_stream.bit_rate = int(encoder['bitrate'])
+
+    if video_stream.codec_context.name == 'libx264':
+        # x264 has its own threads and lookahead
+        x264_params = X264_PARAMS
+        if 'lookahead' in encoder:
+            x264_params += ':rc-lookahead={}'.format(encoder['lookahead'])
+        if encoder.get('thread_type') == 'SLICE':
+            x264_params += ':sliced-threads=1'
+        if 'threads' in encoder:
+            options['threads'] = str(encoder['threads'])
+        options['x264-params'] = x264_params
+    else:
+        video_stream.codec_context.gop_size = GOP_SIZE
+        if 'lookahead' in encoder:
+            options['rc-lookahead'] = str(encoder['lookahead'])
+        if 'thread_type' in encoder:
+            video_stream.thread_type = encoder['thread_type']
+        if 'threads' in encoder:
+            video_stream.thread_count = encoder['threads']
+
+    video_stream.options = options
+
+
+def encoder_profile(name: str = 'default', **settings) -> dict:
+    """
+    Returns the encoder settings of the profile [name] (see ENCODER_PROFILES), overridden by [settings] which are not None
+    """
+    return {**ENCODER_PROFILES[name], **{setting: value for setting, value in settings.items() if value is not None}}
+
+
+def get_plane_array(plane) -> np.array:
+    """
+    Returns a writable view on the pixels of the 8 bits video plane [plane] (without line padding)
+    """
+    return np.frombuffer(plane, np.uint8).reshape(plane.height, plane.line_size)[:, :plane.width]
+
+
+def get_luma_frame(frame):
     """
-    An iterator to simplify iteration through video and audio packets 
+    Returns [frame], converted to a pixel format with an 8 bits Y plane if needed
     """
+    if frame.format.name not in LUMA_FORMATS:
+        return frame.reformat(format='yuv420p')
+    return frame
 
-    def __init__(self, input_video_packets, input_audio_packets, bar=None):
-        self.input_video_packets = input_video_packets
-        self.input_audio_packets = input_audio_packets
+
+class PacketIterator:
+    """
+    Streams the packets of [streams] from [container] in dts order.
+    Only the packets needed to reorder the streams are kept in memory, for at most REORDER_WINDOW seconds :
+    older packets are yielded in demuxing order
+    """
+
+    def __init__(self, container, *streams, bar=None):
+        self.container = container
+        self.streams = streams
         self.bar = bar
 
 
     def __iter__(self):
-        self.video_index = 0
-        self.audio_index = 0
-        return self
+        queues = {stream.index: deque() for stream in self.streams}
 
+        for packet in profiled('demux', self.container.demux(*self.streams)):
+            # Skip empty packets (end of stream)
+            if packet.dts is None:
+                continue
 
-    def __next__(self):
-        if self.audio_index < len(self.input_audio_packets) or self.video_index < len(self.input_video_packets):
-            audio_packet = None
-            if self.audio_index < len(self.input_audio_packets):
+            count_bytes('read', [packet])
 
-                if self.input_audio_packets[self.audio_index].dts is None:
-                    self.audio_index += 1
-                    return self.__next__()
+            queues[packet.stream.index].append(packet)
 
-                audio_packet = self.input_audio_packets[self.audio_index]
+            # The next packet is known once every stream has one pending
+            while all(queues.values()) or (any(queues.values()) and self._head(queues) < self._time(packet) - REORDER_WINDOW):
+                yield self._pop(queues)
 
-            video_packet = None
-            if self.video_index < len(self.input_video_packets):
+        while any(queues.values()):
+            yield self._pop(queues)
 
-                if self.input_video_packets[self.video_index].dts is None:
-                    self.video_index += 1
-                    if self.bar:
-                        self.bar()
-                    return self.__next__()
 
-                video_packet = self.input_video_packets[self.video_index]
+    @staticmethod
+    def _time(packet):
+        return packet.dts * packet.time_base
 
-            if (video_packet is None) or (audio_packet is not None and audio_packet.dts < video_packet.dts):
-                self.audio_index += 1
-            else:
-                self.video_index += 1
-                if self.bar:
-                    self.bar()
 
-            return (video_packet, audio_packet)
+    def _head(self, queues):
+        return min(self._time(queue[0]) for queue in queues.values() if queue)
 
-        else:
-            raise StopIteration
 
+    def _pop(self, queues):
+        queue = min((queue for queue in queues.values() if queue), key=lambda queue: self._time(queue[0]))
+        packet = queue.popleft()
+
+        if self.bar and packet.stream.type == 'video':
+            self.bar()
+
+        return packet
 
-def encode_watermark(symbol: bool, key: int, n_dct: int, alpha: float, movie_filename: str, watermarked_filename: str) -> None:
+
+def batched(iterable, size: int):
     """
-    Encode symbol [symbol] in [watermarked_filename] using private key [key]
-    and spread spectrum parameters [n_dct] (size of modified DCT square) and [alpha] (strength)
+    Yields the items of [iterable] by lists of [size] items (the last one may be shorter)
     """
-    G = compute_G(key, n_dct)
-    input_video_packets, input_audio_packets, input_video_stream, input_audio_stream = open_existing_movie(movie_filename)
-    watermarked_container, watermarked_video_stream, watermarked_audio_stream = create_movie_from(input_video_stream, input_audio_stream, watermarked_filename)
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
-    with alive_bar(len(input_video_packets)) as bar:
-        video_iterator = VideoIterator(input_video_packets, input_audio_packets, bar=bar)
 
-        for video_packet, audio_packet in iter(video_iterator):
-            if (video_packet is None) or ((audio_packet is not None) and (audio_packet.dts < video_packet.dts)):
-                audio_packet.stream = watermarked_audio_stream
-                watermarked_container.mux(audio_packet)
-                continue
+def run_pipeline(items, transform: Callable, sink: Callable, queue_depth: int = QUEUE_DEPTH, workers: int = None) -> None:
+    """
+    Runs [sink] on the results of [transform] for each item of [items], in the order of [items], on three stages :
+    [items] is iterated (demuxing and decoding) in a thread of its own, [transform] runs in a pool of [workers] threads,
+    and [sink] (encoding and muxing) runs in the calling thread. At most [queue_depth] items wait for [sink],
+    so that the decoding waits when the other stages are late.
+    If [transform] is None, the items are given to [sink] as they are.
+    If [sink] returns True, the remaining items are neither iterated nor given to [sink]
+    """
+    pending = queue.Queue(maxsize=queue_depth)
+    done = object()
+    stop = threading.Event()
+
+    with ThreadPoolExecutor(workers) as executor:
+        def produce():
+            try:
+                for item in items:
+                    if stop.is_set():
+                        break
+                    item = executor.submit(transform, item) if transform else item
+                    with stage('wait_queue_full'):
+                        pending.put(item)
+                pending.put(done)
+            except BaseException as error:
+                pending.put(error)
+
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+
+        item = None
+        try:
+            while True:
+                with stage('wait_queue_empty'):
+                    item = pending.get()
+                if item is done or isinstance(item, BaseException):
+                    break
+                if stop.is_set():
+                    # Only unblock the producer
+                    continue
+                if transform:
+                    with stage('wait_transform'):
+                        item = item.result()
+                if sink(item):
+                    stop.set()
+        finally:
+            # If [transform] or [sink] failed, unblock the producer so that it stops (and releases [items])
+            stop.set()
+            while item is not done and not isinstance(item, BaseException):
+                item = pending.get()
+            producer.join()
+
+        if isinstance(item, BaseException):
+            raise item
+
+
+def get_rgb_array(plane) -> np.array:
+    """
+    Returns a writable view on the pixels of the packed rgb24 plane [plane], as a (height, width, 3) array
+    """
+    return np.frombuffer(plane, np.uint8).reshape(plane.height, plane.line_size)[:, :3*plane.width].reshape(plane.height, plane.width, 3)
+
+
+def get_plane_arrays(frame) -> list:
+    """
+    Returns writable views on the pixels of the planes of [frame] (packed rgb24, or 8 bits planes)
+    """
+    if frame.format.name == 'rgb24':
+        return [get_rgb_array(frame.planes[0])]
+    return [get_plane_array(plane) for plane in frame.planes]
+
+
+def get_watermarked_array(frame) -> np.array:
+    """
+    Returns the array of pixels of [frame] which is watermarked : the CHANNEL of an rgb24 frame,
+    otherwise the Y plane (see get_luma_frame)
+    """
+    if frame.format.name == 'rgb24':
+        return get_rgb_array(frame.planes[0])[:,:,CHANNEL]
+    return get_plane_array(frame.planes[0])
+
+
+class BatchWatermarker:
+    """
+    Adds the spatial contribution of the middle DCT coefficients [w] to batches of at most [batch_size] decoded frames.
+    The watermarked pixels (Y plane if [luma], otherwise the CHANNEL of the RGB image) are copied into
+    a preallocated float32 buffer (one per thread), and the watermark is added to the whole batch at once.
+    The results are written into preallocated output frames, which are reused once given back to release
+    """
+
+    def __init__(self, w: np.array, luma: bool = False, batch_size: int = FRAME_BATCH_SIZE):
+        self.w = w
+        self.luma = luma
+        self.batch_size = batch_size
+        self.pattern = None
+        self.free_frames = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+
+    def __call__(self, frames: list) -> list:
+        """
+        Returns the watermarked batch [frames]
+        """
+        with stage('convert', len(frames)):
+            frames = [get_luma_frame(frame) if self.luma else frame.reformat(format='rgb24') for frame in frames]
+        shape = get_watermarked_array(frames[0]).shape
+
+        with self.lock:
+            if self.pattern is None:
+                # +0.5 to round to the nearest integer when converting back to 8 bits on the Y plane
+                self.pattern = (255 * get_middle_coefs_pattern(shape, self.w) + (0.5 if self.luma else 0)).astype(np.float32)
+            out_frames = [self.free_frames.pop() if self.free_frames else av.VideoFrame(frame.width, frame.height, frame.format.name)
+                          for frame in frames]
+
+        if getattr(self.local, 'buffer', None) is None:
+            self.local.buffer = np.empty((self.batch_size,) + shape, np.float32)
+        batch = self.local.buffer[:len(frames)]
+
+        with stage('watermark', len(frames)):
+            for frame, pixels in zip(frames, batch):
+                np.copyto(pixels, get_watermarked_array(frame))
+
+            # y = x+w on the middle DCT coefficients.
+            # The DCT being linear, only the spatial contribution of w needs to be added
+            np.add(batch, self.pattern, out=batch)
+            np.clip(batch, 0, 255, out=batch)
+
+            for frame, out_frame, watermarked in zip(frames, out_frames, batch):
+                # Other planes and channels are left untouched
+                for array, out_array in zip(get_plane_arrays(frame), get_plane_arrays(out_frame)):
+                    np.copyto(out_array, array)
+                np.copyto(get_watermarked_array(out_frame), watermarked, casting='unsafe')
+
+                # Let the encoder number the frames, as for a new frame
+                out_frame.pts = None
+
+        return out_frames
+
+
+    def release(self, out_frames: list) -> None:
+        """
+        Gives back output frames once they are encoded
+        """
+        with self.lock:
+            self.free_frames.extend(out_frames)
+
+
+def get_watermarker(symbol: bool, key: int, n_dct: int, alpha: float, luma: bool = False, legacy: bool = True):
+    """
+    Returns the function watermarking a decoded frame with symbol [symbol],
+    for the parameters of encode_watermark
+    """
+    w = compute_watermark(symbol, key, n_dct, alpha, legacy)
+    return BatchWatermarker(w, luma)
+
 
-            for frame in video_packet.decode():
-                image = frame.to_image()
-                array = np.array(image)
+def mux_packets(container, packets: list) -> None:
+    """
+    Muxes [packets] into [container]
+    """
+    with stage('mux'):
+        container.mux(packets)
+    count_bytes('written', packets)
 
-                array_dct = cv2.dct(array[:,:,CHANNEL]/255)
-                # Middle coefficients
-                middle_slice = get_middle_coefs_slice(array_dct, n_dct)
-                # Watermark
-                w = np.reshape(alpha * (G if symbol else -G), (n_dct,n_dct))
-                # y = x+w
-                middle_slice += w
-                # Keep DCT coefficients between 0 and 1
-                middle_slice = np.minimum(np.maximum(middle_slice, 0), 1)
-                # Convert back to image from frequency domain
-                array[:,:,CHANNEL] = cv2.idct(array_dct*255)
 
-                image = Image.fromarray(array)
-                out_frame = av.VideoFrame.from_image(image)
-                out_packet = watermarked_video_stream.encode(out_frame)
-                watermarked_container.mux(out_packet)
+def encode_frame(container, video_stream, frame) -> None:
+    """
+    Encodes [frame] with the encoder of [video_stream] and muxes the packets into [container]
+    """
+    with stage('encode', int(frame is not None)):
+        packets = video_stream.encode(frame)
+    mux_packets(container, packets)
 
 
+def flush_movie(container, video_stream) -> None:
+    """
+    Encodes the frames remaining in the encoder of [video_stream] and closes [container]
+    """
     try:
-        for packet in watermarked_video_stream.encode():
-            watermarked_container.mux(packet)
+        encode_frame(container, video_stream, None)
 
     except EOFError:
         print("ERROR when writing to video file")
 
-    watermarked_container.close()
+    container.close()
+
+
+def encode_watermark(symbol: bool, key: int, n_dct: int, alpha: float, movie_filename: str, watermarked_filename: str, luma: bool = False, legacy: bool = True,
+                     queue_depth: int = QUEUE_DEPTH, workers: int = None, encoder: dict = None, decoder: dict = None) -> None:
+    """
+    Encode symbol [symbol] in [watermarked_filename] using private key [key]
+    and spread spectrum parameters [n_dct] (size of modified DCT square) and [alpha] (strength).
+    If [luma], the Y plane of the decoded frames is watermarked instead of the CHANNEL of the RGB image.
+    Decoding, watermarking (by [workers] threads) and encoding run in parallel (see run_pipeline).
+    [encoder] are the settings of the encoder (see configure_encoder), [decoder] the threads of the decoder (see open_existing_movie)
+    """
+    watermarker = get_watermarker(symbol, key, n_dct, alpha, luma, legacy)
+
+    movie = open_existing_movie(movie_filename, **(decoder or {}))
+    watermarked = create_movie_from(movie[1], movie[2], watermarked_filename, encoder=encoder)
+
+    with alive_bar(count_frames(movie[1])) as bar:
+        watermark_movie(watermarker, movie, watermarked, queue_depth=queue_depth, workers=workers, bar=bar)
+
+    flush_movie(watermarked[0], watermarked[1])
+    movie[0].close()
+
 
+def watermark_movie(watermarker, movie: tuple, watermarked: tuple, keep_pts: bool = False, queue_depth: int = QUEUE_DEPTH, workers: int = None, bar=None) -> None:
+    """
+    Watermarks the frames of [movie] with [watermarker] (see get_watermarker) and encodes them into [watermarked],
+    copying the audio. Both are open (container, video stream, audio stream), as given by open_existing_movie
+    and create_movie_from, and [watermarked] is not flushed. If [keep_pts], the timestamps of the frames are kept,
+    otherwise the encoder numbers them
+    """
+    input_container, input_video_stream, input_audio_stream = movie
+    watermarked_container, watermarked_video_stream, watermarked_audio_stream = watermarked
+
+    def decode():
+        # Audio packets, and batches of decoded frames
+        frames = []
+        for packet in PacketIterator(input_container, input_video_stream, input_audio_stream, bar=bar):
+            if packet.stream.type == 'audio':
+                yield packet
+                continue
+
+            frames += decode_packet(packet)
+            while len(frames) >= watermarker.batch_size:
+                yield frames[:watermarker.batch_size]
+                frames = frames[watermarker.batch_size:]
+
+        # Nothing may stay in the decoder (the movie may be a segment of a stream)
+        frames += flush_decoder(input_video_stream)
+        for batch in batched(frames, watermarker.batch_size):
+            yield batch
+
+    def watermark(item):
+        if isinstance(item, av.Packet):
+            return item
+
+        out_frames = watermarker(item)
+        if keep_pts:
+            for frame, out_frame in zip(item, out_frames):
+                out_frame.pts = frame.pts
+                out_frame.time_base = frame.time_base
+        return out_frames
+
+    def write(item):
+        if isinstance(item, av.Packet):
+            item.stream = watermarked_audio_stream
+            mux_packets(watermarked_container, [item])
+            return
+
+        for out_frame in item:
+            encode_frame(watermarked_container, watermarked_video_stream, out_frame)
+        watermarker.release(item)
+
+    run_pipeline(decode(), watermark, write, queue_depth, workers)
+
+
+def split_segments(video_stream, n_segments: int) -> list:
+    """
+    Splits [video_stream] into at most [n_segments] segments of consecutive frames, as (start pts, end pts)
+    (end pts is None for the last segment). Each segment has a multiple of GOP_SIZE frames,
+    so that the GOPs of the concatenated segments stay aligned on the GOPs of a single encoding.
+    Only the packets are read, nothing is decoded
+    """
+    container = video_stream.container
+    pts = sorted(packet.pts for packet in container.demux(video_stream) if packet.pts is not None)
+    container.seek(0)
+
+    # Round the size of the segments up to a multiple of GOP_SIZE
+    segment_size = -(-len(pts) // (n_segments * GOP_SIZE)) * GOP_SIZE
+    starts = pts[::segment_size]
+    return list(zip(starts, starts[1:] + [None]))
+
+
+def encode_watermark_segment(symbol: bool, key: int, n_dct: int, alpha: float, movie_filename: str, segment_filename: str,
+                             start_pts: int, end_pts: int, luma: bool = False, legacy: bool = True, encoder: dict = None, decoder: dict = None) -> int:
+    """
+    Same as encode_watermark for the frames of [movie_filename] with start_pts <= pts < end_pts
+    (until the end if [end_pts] is None), without audio.
+    Returns the number of encoded frames
+    """
+    watermarker = get_watermarker(symbol, key, n_dct, alpha, luma, legacy)
+
+    input_container, input_video_stream, input_audio_stream = open_existing_movie(movie_filename, **(decoder or {}))
+    segment_container, segment_video_stream, _ = create_movie_from(input_video_stream, None, segment_filename, encoder=encoder)
+
+    # Start decoding from the keyframe before the segment
+    input_container.seek(start_pts, stream=input_video_stream)
+    frames = 0
+
+    def decode():
+        packets = (packet for packet in input_container.demux(input_video_stream) if packet.dts is not None)
+        for frame in decode_frames(packets, input_video_stream):
+            if frame.pts < start_pts:
+                continue
+            if end_pts is not None and frame.pts >= end_pts:
+                return
+            yield frame
 
-def encode_AB(msg: bytes, input_A_filename: str, input_B_filename: str, out_filename: str, freq: float) -> None:
+    def write(out_frames):
+        nonlocal frames
+        for out_frame in out_frames:
+            encode_frame(segment_container, segment_video_stream, out_frame)
+        watermarker.release(out_frames)
+        frames += len(out_frames)
+
+    run_pipeline(batched(decode(), watermarker.batch_size), watermarker, write)
+
+    flush_movie(segment_container, segment_video_stream)
+    input_container.close()
+    return frames
+
+
+def encode_watermark_parallel(symbol: bool, key: int, n_dct: int, alpha: float, movie_filename: str, watermarked_filename: str,
+                              luma: bool = False, processes: int = None, legacy: bool = True, encoder: dict = None, decoder: dict = None) -> None:
+    """
+    Same as encode_watermark, but the video is split into segments (see split_segments)
+    which are watermarked by a pool of [processes] processes (by default, one per CPU).
+    The encoded segments are then concatenated without re-encoding, and the audio is copied once
+    """
+    processes = processes or os.cpu_count()
+
+    input_container, input_video_stream, input_audio_stream = open_existing_movie(movie_filename)
+    segments = split_segments(input_video_stream, processes)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        segment_filenames = [os.path.join(tmp_dir, '{}.mp4'.format(i)) for i in range(len(segments))]
+        segment_frames = [0] * len(segments)
+
+        with alive_bar(len(segments)) as bar, ProcessPoolExecutor(processes) as executor:
+            futures = {executor.submit(encode_watermark_segment, symbol, key, n_dct, alpha, movie_filename, segment_filename,
+                                       start_pts, end_pts, luma, legacy, encoder, decoder): i
+                       for i, (segment_filename, (start_pts, end_pts)) in enumerate(zip(segment_filenames, segments))}
+
+            for future in as_completed(futures):
+                segment_frames[futures[future]] = future.result()
+                bar()
+
+        concat_segments(segment_filenames, segment_frames, input_container, input_video_stream, input_audio_stream, watermarked_filename)
+
+    input_container.close()
+
+
+def concat_segments(segment_filenames: list, segment_frames: list, input_container, input_video_stream, input_audio_stream, out_filename: str) -> None:
+    """
+    Concatenates the video segments [segment_filenames] (of [segment_frames] frames each) into [out_filename],
+    with the audio stream of [input_container]. Packets are copied without re-encoding
+    """
+    fps = input_video_stream.average_rate
+    segment_containers = [av.open(segment_filename) for segment_filename in segment_filenames]
+
+    out_container = av.open(out_filename, mode="w")
+    out_video_stream = out_container.add_stream(template=segment_containers[0].streams.video[0])
+    out_audio_stream = out_container.add_stream(template=input_audio_stream)
+
+    def video_packets():
+        frames = 0
+        for segment_container, n_frames in zip(segment_containers, segment_frames):
+            for packet in segment_container.demux(segment_container.streams.video[0]):
+                if packet.dts is None:
+                    continue
+                # Shift the timestamps by the duration of the previous segments
+                offset = round(frames / fps / packet.time_base)
+                packet.pts += offset
+                packet.dts += offset
+                yield packet
+            frames += n_frames
+
+    audio_packets = PacketIterator(input_container, input_audio_stream)
+
+    for packet in heapq.merge(video_packets(), audio_packets, key=lambda packet: packet.dts * packet.time_base):
+        packet.stream = out_audio_stream if packet.stream.type == 'audio' else out_video_stream
+        mux_packets(out_container, [packet])
+
+    out_container.close()
+    for segment_container in segment_containers:
+        segment_container.close()
+
+
+def file_hash(filename: str) -> str:
+    """
+    Returns the SHA-256 of the content of [filename].
+    It is only computed again if the size or the modification time of the file changed
+    """
+    stat = os.stat(filename)
+    return _file_hash(os.path.abspath(filename), stat.st_size, stat.st_mtime_ns)
+
+
+@lru_cache(maxsize=256)
+def _file_hash(filename: str, size: int, mtime: int) -> str:
+    sha = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(2**20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class MasterCache:
+    """
+    Watermarked masters (outputs of encode_watermark) saved in the directory [path], at most [max_size] bytes.
+    A master is identified by the content of its source and every parameter of the watermarking,
+    including the encoder settings. The least recently used masters are evicted first
+    """
+
+    def __init__(self, path: str, max_size: int = MASTER_CACHE_SIZE):
+        self.path = path
+        self.max_size = max_size
+        os.makedirs(path, exist_ok=True)
+
+
+    def master_filename(self, symbol: bool, key: int, n_dct: int, alpha: float, movie_filename: str, luma: bool = False, legacy: bool = True,
+                        encoder: dict = None) -> str:
+        """
+        Returns the filename of the master in the cache (which may not exist yet)
+        """
+        parameters = json.dumps([file_hash(movie_filename), int(symbol), key, n_dct, alpha, luma, legacy, X264_PARAMS, encoder or {}], sort_keys=True)
+        return os.path.join(self.path, hashlib.sha256(parameters.encode()).hexdigest() + '.mp4')
+
+
+    def get_master(self, symbol: bool, key: int, n_dct: int, alpha: float, movie_filename: str, luma: bool = False, legacy: bool = True,
+                   processes: int = None, in_use: tuple = (), encoder: dict = None, decoder: dict = None) -> str:
+        """
+        Returns the filename of the master watermarked with the parameters of encode_watermark.
+        It is only computed (by encode_watermark_parallel if [processes] is given) if it is not in the cache.
+        The master is written under a temporary name then renamed, so concurrent jobs never see a partial master.
+        The masters of [in_use] (still needed by the caller) are not evicted
+        """
+        master_filename = self.master_filename(symbol, key, n_dct, alpha, movie_filename, luma, legacy, encoder)
+
+        if os.path.exists(master_filename):
+            # Mark as recently used
+            os.utime(master_filename)
+            self.evict(keep=(master_filename, *in_use))
+            return master_filename
+
+        fd, tmp_filename = tempfile.mkstemp(suffix='.mp4', prefix='tmp-', dir=self.path)
+        os.close(fd)
+        try:
+            if processes is not None:
+                encode_watermark_parallel(symbol, key, n_dct, alpha, movie_filename, tmp_filename, luma=luma, processes=processes, legacy=legacy,
+                                          encoder=encoder, decoder=decoder)
+            else:
+                encode_watermark(symbol, key, n_dct, alpha, movie_filename, tmp_filename, luma=luma, legacy=legacy, encoder=encoder, decoder=decoder)
+            # mkstemp creates the file readable by its owner only
+            os.chmod(tmp_filename, 0o644)
+            os.replace(tmp_filename, master_filename)
+        finally:
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+
+        self.evict(keep=(master_filename, *in_use))
+        return master_filename
+
+
+    def evict(self, keep: tuple = ()) -> None:
+        """
+        Removes the least recently used masters (except the ones of [keep], and the ones used in the last MASTER_GRACE_PERIOD seconds)
+        until the cache fits in its maximum size
+        """
+        recent = time.time() - MASTER_GRACE_PERIOD
+        masters = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith('.mp4') and not entry.name.startswith('tmp-'):
+                try:
+                    masters.append((entry.stat().st_mtime, entry.stat().st_size, entry.path))
+                except FileNotFoundError: # Removed by another job
+                    pass
+
+        size = sum(master_size for mtime, master_size, path in masters)
+        for mtime, master_size, path in sorted(masters):
+            if size <= self.max_size or mtime > recent:
+                break
+            if path in keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= master_size
+
+
+def read_symbol(bs: ConstBitStream, repeat: bool = False) -> int:
+    """
+    Reads the next symbol of the message bitstream [bs].
+    If [repeat], the message starts again once all its bits are read, otherwise 0 is read
+    """
+    if repeat and bs.pos == len(bs):
+        bs.pos = 0
+    try:
+        return bs.read(1).bool
+    except ReadError: # By default, add
+        return 0
+
+
+def read_messages(messages_filename: str) -> list:
+    """
+    Reads the messages (IDs) in [messages_filename], one per line ("-" for stdin)
+    """
+    messages_file = sys.stdin if messages_filename == '-' else open(messages_filename)
+    messages = [int(line) for line in messages_file if line.strip()]
+    if messages_file is not sys.stdin:
+        messages_file.close()
+    return messages
+
+
+def message_to_bytes(message: int, length: int = None, checksum: bool = False) -> bytes:
+    """
+    Converts the message (ID) [message] to bytes, as expected by encode_AB : [length] bytes
+    (by default, as few as possible), followed by CHECKSUM_BYTES bytes of checksum if [checksum]
+    """
+    msg = message.to_bytes(length or max(1, (message.bit_length()+7)//8))
+    if checksum:
+        msg += (zlib.crc32(msg) % 2**(8*CHECKSUM_BYTES)).to_bytes(CHECKSUM_BYTES)
+    return msg
+
+
+def bytes_to_message(msg: bytes, checksum: bool = False) -> int:
+    """
+    Converts the bytes [msg] written by message_to_bytes back to the message (ID).
+    If [checksum], returns None if the checksum is wrong
+    """
+    if checksum:
+        msg, msg_checksum = msg[:-CHECKSUM_BYTES], msg[-CHECKSUM_BYTES:]
+        if message_to_bytes(int.from_bytes(msg), len(msg), checksum=True)[-CHECKSUM_BYTES:] != msg_checksum:
+            return None
+    return int.from_bytes(msg)
+
+
+class MessageClock:
+    """
+    Symbols of the message [msg] for each frame, as written by encode_AB : a new bit every [skip_frames] frames.
+    The position in the message and the frame counter are kept from one segment of a stream to the next.
+    If [repeat], the message is repeated once all its bits are written (a live stream has no end), otherwise the next bits are 0
+    """
+
+    def __init__(self, msg: bytes, skip_frames: int, repeat: bool = True):
+        self.bitstream = ConstBitStream(msg)[::-1]
+        self.skip_frames = skip_frames
+        self.repeat = repeat
+        self.frames = 0
+        self.symbol = 0
+
+
+    def __call__(self) -> int:
+        """
+        Returns the symbol of the next frame
+        """
+        if self.frames == 0:
+            self.symbol = read_symbol(self.bitstream, self.repeat)
+
+        self.frames = (self.frames+1) % self.skip_frames
+        return self.symbol
+
+
+def encode_AB(msg: bytes, input_A_filename: str, input_B_filename: str, out_filename: str, freq: float, queue_depth: int = QUEUE_DEPTH,
+              repeat: bool = False, encoder: dict = None, decoder: dict = None) -> None:
     """
     Encode message [msg] in [out_filename] using an A/B encoding procedure
-    with input files [input_A_filename] and [input_B_filename] at frequency [freq]
+    with input files [input_A_filename] and [input_B_filename] at frequency [freq].
+    If [repeat], the message is repeated until the end of the video (see decode_AB_incremental),
+    otherwise the bits after the message are 0.
+    [encoder] and [decoder] are the settings of the encoder and the decoders (see encode_watermark)
+    """
+    encode_AB_batch([msg], input_A_filename, input_B_filename, [out_filename], freq, queue_depth, repeat, encoder, decoder)
+
+
+def encode_AB_batch(msgs: list, input_A_filename: str, input_B_filename: str, out_filenames: list, freq: float,
+                    queue_depth: int = QUEUE_DEPTH, repeat: bool = False, encoder: dict = None, decoder: dict = None) -> None:
+    """
+    Same as encode_AB for each message of [msgs] and corresponding output of [out_filenames] :
+    A and B are only read and decoded once, and every chosen frame is encoded by each output.
+    A and B are decoded in a thread of their own, while the outputs are encoded (see run_pipeline)
+    """
+    movie_A = open_existing_movie(input_A_filename, **(decoder or {}))
+    movie_B = open_existing_movie(input_B_filename, **(decoder or {}))
+    outputs = [create_movie_from(movie_A[1], movie_A[2], out_filename, encoder=encoder) for out_filename in out_filenames]
+
+    assert count_frames(movie_A[1]) == count_frames(movie_B[1])
+    fps = movie_A[1].average_rate
+    assert fps == movie_B[1].average_rate
+
+    clocks = [MessageClock(msg, int(fps / freq), repeat) for msg in msgs]
+
+    with alive_bar(count_frames(movie_A[1])) as bar:
+        encode_AB_movie(clocks, movie_A, movie_B, outputs, queue_depth, bar)
+
+    for out_container, out_video_stream, out_audio_stream in outputs:
+        flush_movie(out_container, out_video_stream)
+    movie_A[0].close()
+    movie_B[0].close()
+
+
+def encode_AB_movie(clocks: list, movie_A: tuple, movie_B: tuple, outputs: list, queue_depth: int = QUEUE_DEPTH, bar=None) -> None:
     """
-    bs = ConstBitStream(msg)[::-1]
+    Encodes into each of [outputs] the frames of [movie_A] or [movie_B] chosen by the corresponding MessageClock of [clocks],
+    copying the audio of A. The movies are open (container, video stream, audio stream), as given by open_existing_movie
+    and create_movie_from, and the outputs are not flushed.
+    A and B are decoded in a thread of their own, while the outputs are encoded (see run_pipeline)
+    """
+    input_A_container, input_A_video_stream, input_A_audio_stream = movie_A
+    input_B_container, input_B_video_stream, input_B_audio_stream = movie_B
+
+    def decode():
+        # Audio packets, and decoded frames of A and B with the symbol of each output
+        packet_iterator_A = PacketIterator(input_A_container, input_A_video_stream, input_A_audio_stream, bar=bar)
+        packet_iterator_B = PacketIterator(input_B_container, input_B_video_stream, input_B_audio_stream)
+
+        for packet_A, packet_B in zip(packet_iterator_A, packet_iterator_B):
+            assert packet_A.stream.type == packet_B.stream.type, "A and B packets are not aligned"
+
+            if packet_A.stream.type == 'audio':
+                yield packet_A
+                continue
+
+            for (f1, f2) in zip(decode_packet(packet_A), decode_packet(packet_B)):
+                yield f1, f2, [clock() for clock in clocks]
+
+        # Nothing may stay in the decoders (the movies may be segments of streams)
+        for (f1, f2) in zip(flush_decoder(input_A_video_stream), flush_decoder(input_B_video_stream)):
+            yield f1, f2, [clock() for clock in clocks]
+
+    def write(item):
+        if isinstance(item, av.Packet):
+            for out_container, out_video_stream, out_audio_stream in outputs:
+                item.stream = out_audio_stream
+                mux_packets(out_container, [item])
+            return
+
+        f1, f2, symbols = item
+        for (out_container, out_video_stream, out_audio_stream), symbol in zip(outputs, symbols):
+            encode_frame(out_container, out_video_stream, (f1, f2)[symbol])
+
+    # Nothing to compute between decoding and encoding
+    run_pipeline(decode(), None, write, queue_depth)
+
+
+def remux_AB(msg: bytes, input_A_filename: str, input_B_filename: str, out_filename: str, freq: float, repeat: bool = False) -> None:
+    """
+    Same as encode_AB, but whole GOPs of [input_A_filename] or [input_B_filename] are copied
+    as compressed packets into [out_filename] : nothing is decoded nor re-encoded.
+    Each bit period is aligned on keyframes, so (fps / [freq]) should be a multiple of the GOP size
+    used in create_movie_from, otherwise a GOP takes the bit of the period it starts in.
+    """
+    remux_AB_batch([msg], input_A_filename, input_B_filename, [out_filename], freq, repeat)
+
 
-    input_A_video_packets, input_A_audio_packets, input_A_video_stream, input_A_audio_stream = open_existing_movie(input_A_filename)
-    input_B_video_packets, input_B_audio_packets, input_B_video_stream, input_B_audio_stream = open_existing_movie(input_B_filename)
-    out_container, out_video_stream, out_audio_stream = create_movie_from(input_A_video_stream, input_A_audio_stream, out_filename)
+def remux_AB_batch(msgs: list, input_A_filename: str, input_B_filename: str, out_filenames: list, freq: float, repeat: bool = False) -> None:
+    """
+    Same as remux_AB for each message of [msgs] and corresponding output of [out_filenames] :
+    A and B are only read once, and each packet is muxed in every output
+    """
+    input_A_container, input_A_video_stream, input_A_audio_stream = open_existing_movie(input_A_filename)
+    input_B_container, input_B_video_stream, input_B_audio_stream = open_existing_movie(input_B_filename)
 
-    assert len(input_A_video_packets) == len(input_B_video_packets)
+    assert count_frames(input_A_video_stream) == count_frames(input_B_video_stream)
     fps = input_A_video_stream.average_rate
     assert fps == input_B_video_stream.average_rate
 
-    skip_frames = int(fps / freq)
-    frames = 0
-    frame_index = 0
+    with alive_bar(count_frames(input_A_video_stream)) as bar:
+        packet_iterator_A = PacketIterator(input_A_container, input_A_video_stream, input_A_audio_stream, bar=bar)
+        packet_iterator_B = PacketIterator(input_B_container, input_B_video_stream, input_B_audio_stream)
 
-    with alive_bar(len(input_A_video_packets)) as bar:
-        video_iterator_A = VideoIterator(input_A_video_packets, input_A_audio_packets, bar=bar)
-        video_iterator_B = VideoIterator(input_B_video_packets, input_B_audio_packets)
+        remux_AB_packets(msgs, packet_iterator_A, packet_iterator_B, input_A_video_stream, input_A_audio_stream, out_filenames, fps / freq, repeat)
 
-        for (video_packet_A, audio_packet_A), (video_packet_B, audio_packet_B) in zip(iter(video_iterator_A), iter(video_iterator_B)):
-            if (video_packet_A is None) or ((audio_packet_A is not None) and (audio_packet_A.dts < video_packet_A.dts)):
-                audio_packet_A.stream = out_audio_stream
-                out_container.mux(audio_packet_A)
-                continue
+    input_A_container.close()
+    input_B_container.close()
 
-            for (f1, f2) in zip(video_packet_A.decode(), video_packet_B.decode()):
-                if frames == 0:
-                    try:
-                        frame_index = bs.read(1).bool
-                    except ReadError: # By default, add
-                        frame_index = 0
 
-                f = (f1,f2)[frame_index]
+def remux_AB_packets(msgs: list, packets_A, packets_B, video_stream, audio_stream, out_filenames: list, skip_frames: int, repeat: bool = False) -> None:
+    """
+    Same as remux_AB_batch, from the packets [packets_A] and [packets_B] of A and B (in dts order, as given by PacketIterator),
+    with a new bit every [skip_frames] frames. The streams of the outputs are copies of [video_stream] and [audio_stream].
+    [skip_frames] is rounded down as in encode_AB, and since whole GOPs are copied, it must then be a multiple of GOP_SIZE
+    """
+    skip_frames = int(skip_frames)
+    if skip_frames % GOP_SIZE != 0:
+        raise ValueError("remuxing requires bit periods of a multiple of {} frames, not {} frames".format(GOP_SIZE, skip_frames))
 
-                out_packet = out_video_stream.encode(f)
-                out_container.mux(out_packet)
+    bitstreams = [ConstBitStream(msg)[::-1] for msg in msgs]
 
-                frames = (frames+1) % skip_frames
+    # Copy the streams as they are
+    outputs = []
+    for out_filename in out_filenames:
+        out_container = av.open(out_filename, mode="w")
+        out_video_stream = out_container.add_stream(template=video_stream)
+        out_audio_stream = out_container.add_stream(template=audio_stream)
+        outputs.append((out_container, out_video_stream, out_audio_stream))
 
-    try:
-        for packet in out_video_stream.encode():
-            out_container.mux(packet)
+    frame_index = 0 # Index of the current frame (in decoding order)
+    bit_index = -1 # Index of the last bit read from the bitstreams
+    symbols = [0] * len(outputs)
 
-    except EOFError:
-        print("ERROR when writing to video file")
+    for packet_A, packet_B in zip(packets_A, packets_B):
+        assert packet_A.stream.type == packet_B.stream.type, "A and B packets are not aligned"
 
-    out_container.close()
+        if packet_A.stream.type == 'audio':
+            for out_container, out_video_stream, out_audio_stream in outputs:
+                packet_A.stream = out_audio_stream
+                mux_packets(out_container, [packet_A])
+            continue
+
+        # Only switch between A and B at the beginning of a GOP
+        if packet_A.is_keyframe:
+            assert packet_B.is_keyframe, "A and B GOPs are not aligned"
+            while bit_index < frame_index // skip_frames:
+                symbols = [read_symbol(bs, repeat) for bs in bitstreams]
+                bit_index += 1
+
+        for (out_container, out_video_stream, out_audio_stream), symbol in zip(outputs, symbols):
+            packet = (packet_A, packet_B)[symbol]
+            packet.stream = out_video_stream
+            mux_packets(out_container, [packet])
+
+        frame_index += 1
+
+    for out_container, out_video_stream, out_audio_stream in outputs:
+        out_container.close()
+
+
+def segment_order(name: str) -> tuple:
+    """
+    Sort key of the segment filenames : numbered segments are sorted by number (seg9.ts before seg10.ts)
+    """
+    return len(name), name
+
+
+def watch_segments(source: str, timeout: float = None):
+    """
+    Yields the filenames of the segments of [source] as soon as they are complete.
+    If [source] is "-", the filenames are read from stdin, one per line, a segment being complete once its filename is written.
+    Otherwise [source] is a directory, whose segments (see SEGMENT_FORMATS) are taken in order (see segment_order) :
+    a segment is complete once the next one appears, or once the stream ends, when the file END_OF_STREAM is created
+    or when no segment appears for [timeout] seconds
+    """
+    if source == '-':
+        for line in sys.stdin:
+            if line.strip():
+                yield line.strip()
+        return
+
+    last = None # Last segment yielded
+    last_change = time.monotonic()
+    while True:
+        # Checked before listing, so that the segments written before the end are listed
+        end = os.path.exists(os.path.join(source, END_OF_STREAM)) or (timeout is not None and time.monotonic() - last_change > timeout)
+
+        segments = sorted((name for name in os.listdir(source)
+                           if os.path.splitext(name)[1] in SEGMENT_FORMATS and (last is None or segment_order(name) > segment_order(last))),
+                          key=segment_order)
+
+        # The last segment may still be written
+        for name in segments if end else segments[:-1]:
+            last = name
+            last_change = time.monotonic()
+            yield os.path.join(source, name)
+
+        if end:
+            return
+        time.sleep(SEGMENT_POLL_INTERVAL)
+
+
+def create_segment_from(video_stream, audio_stream, segment_filename: str, encoder: dict = None):
+    """
+    Same as create_movie_from, for a segment written under a temporary name (see publish_segment) :
+    the format is given by the extension of [segment_filename] (see SEGMENT_FORMATS)
+    """
+    format, options = SEGMENT_FORMATS[os.path.splitext(segment_filename)[1]]
+    return create_movie_from(video_stream, audio_stream, segment_filename + '.tmp', format, options, encoder)
+
+
+def publish_segment(segment_filename: str) -> None:
+    """
+    Renames the segment written by create_segment_from, so that the readers of the output never see a partial segment,
+    and prints its filename (which can be piped to another stream)
+    """
+    os.replace(segment_filename + '.tmp', segment_filename)
+    print(segment_filename, flush=True)
 
 
-def decode_AB(key: int, n_dct: int, movie_filename: str, freq: float) -> BitArray:
+def encode_watermark_stream(symbol: bool, key: int, n_dct: int, alpha: float, source: str, out_dir: str, luma: bool = False, legacy: bool = True,
+                            timeout: float = None, queue_depth: int = QUEUE_DEPTH, workers: int = None, encoder: dict = None, decoder: dict = None) -> None:
+    """
+    Same as encode_watermark for each segment of the stream [source] (see watch_segments) :
+    each segment is watermarked as soon as it is complete, into a segment of the same name in [out_dir].
+    The timestamps of the frames are kept, so that the output segments follow each other as the input ones.
+    END_OF_STREAM is created in [out_dir] once the stream ends
+    """
+    watermarker = get_watermarker(symbol, key, n_dct, alpha, luma, legacy)
+    os.makedirs(out_dir, exist_ok=True)
+
+    for segment_filename in watch_segments(source, timeout):
+        out_filename = os.path.join(out_dir, os.path.basename(segment_filename))
+
+        segment = open_existing_movie(segment_filename, **(decoder or {}))
+        out_segment = create_segment_from(segment[1], segment[2], out_filename, encoder)
+
+        watermark_movie(watermarker, segment, out_segment, keep_pts=True, queue_depth=queue_depth, workers=workers)
+
+        flush_movie(out_segment[0], out_segment[1])
+        segment[0].close()
+        publish_segment(out_filename)
+
+    open(os.path.join(out_dir, END_OF_STREAM), 'w').close()
+
+
+def encode_AB_stream(msg: bytes, source_A: str, source_B: str, out_dir: str, freq: float, repeat: bool = True,
+                     timeout: float = None, queue_depth: int = QUEUE_DEPTH, encoder: dict = None, decoder: dict = None) -> None:
+    """
+    Same as encode_AB for each pair of segments of the streams [source_A] and [source_B] (see watch_segments),
+    which must have the same segment names : each pair is encoded as soon as both are complete, into a segment
+    of the same name in [out_dir]. The bit of the message and the frame counter are carried from one segment
+    to the next (see MessageClock), and the message is repeated if [repeat].
+    END_OF_STREAM is created in [out_dir] once the streams end
+    """
+    clock = None
+    os.makedirs(out_dir, exist_ok=True)
+
+    for segment_A_filename, segment_B_filename in zip(watch_segments(source_A, timeout), watch_segments(source_B, timeout)):
+        assert os.path.basename(segment_A_filename) == os.path.basename(segment_B_filename), "A and B segments are not aligned"
+        out_filename = os.path.join(out_dir, os.path.basename(segment_A_filename))
+
+        segment_A = open_existing_movie(segment_A_filename, **(decoder or {}))
+        segment_B = open_existing_movie(segment_B_filename, **(decoder or {}))
+        out_segment = create_segment_from(segment_A[1], segment_A[2], out_filename, encoder)
+
+        fps = segment_A[1].average_rate
+        assert fps == segment_B[1].average_rate
+        if clock is None:
+            clock = MessageClock(msg, int(fps / freq), repeat)
+
+        encode_AB_movie([clock], segment_A, segment_B, [out_segment], queue_depth)
+
+        flush_movie(out_segment[0], out_segment[1])
+        segment_A[0].close()
+        segment_B[0].close()
+        publish_segment(out_filename)
+
+    open(os.path.join(out_dir, END_OF_STREAM), 'w').close()
+
+
+class BatchCorrelator:
+    """
+    Correlates batches of at most [batch_size] decoded frames with the watermarks [G] (one row per key).
+    The DCT being linear, the correlation of the middle coefficients with a watermark is the dot product
+    of the pixels with the spatial pattern of that watermark : the pixels of the batch (Y plane if [luma],
+    otherwise the CHANNEL of the RGB image) are copied into a preallocated float32 buffer (one per thread),
+    and projected on the patterns of every key as one matrix product
+    """
+
+    def __init__(self, G: np.array, n_dct: int, luma: bool = False, batch_size: int = FRAME_BATCH_SIZE):
+        self.G = G
+        self.n_dct = n_dct
+        self.luma = luma
+        self.batch_size = batch_size
+        self.patterns = None
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+
+    def __call__(self, frames: list) -> np.array:
+        """
+        Returns the correlations of each frame of [frames] with each key
+        """
+        with stage('convert', len(frames)):
+            frames = [get_luma_frame(frame) if self.luma else frame.reformat(format='rgb24') for frame in frames]
+        shape = get_watermarked_array(frames[0]).shape
+
+        with self.lock:
+            if self.patterns is None:
+                # Pixels are divided by 255 before the DCT
+                self.patterns = np.stack([get_middle_coefs_pattern(shape, np.reshape(G_key, (self.n_dct,self.n_dct))) / 255
+                                          for G_key in self.G]).reshape(len(self.G), -1).T.astype(np.float32)
+
+        if getattr(self.local, 'buffer', None) is None:
+            self.local.buffer = np.empty((self.batch_size,) + shape, np.float32)
+        batch = self.local.buffer[:len(frames)]
+
+        with stage('correlate', len(frames)):
+            for frame, pixels in zip(frames, batch):
+                np.copyto(pixels, get_watermarked_array(frame))
+
+            return batch.reshape(len(frames), -1) @ self.patterns
+
+
+    def correlate_tagged(self, tagged_frames: list) -> list:
+        """
+        Same as calling with the frames of the (tag, frame) of [tagged_frames], but returns the (tag, correlations)
+        """
+        tags, frames = zip(*tagged_frames)
+        return list(zip(tags, self(frames)))
+
+
+def correlations_to_message(c: np.array) -> BitArray:
+    """
+    Returns the message decoded from the correlations [c] of each bit period (first bit first).
+    The watermark of a 1 is +alpha * G (see compute_watermark), so its correlation is positive,
+    in RGB as on the Y plane (see tests/test_watermark.py)
+    """
+    return BitArray((c > 0).tolist())[::-1]
+
+
+def correlations_to_confidence(c: np.array) -> float:
+    """
+    Returns the confidence of the message decoded from the correlations [c] of each bit period :
+    their mean, counted positively for the 0 bits, so that the confidence of an ID (mostly 0 bits) is positive
+    """
+    return -c.mean()
+
+
+def decode_AB(key: int, n_dct: int, movie_filename: str, freq: float, luma: bool = False, legacy: bool = True,
+              queue_depth: int = QUEUE_DEPTH, workers: int = None, decoder: dict = None) -> BitArray:
     """
     Extract message from video [movie_filename]at frequence [freq]
-    with secret key [key] and DCT square size [n_dct]
+    with secret key [key] and DCT square size [n_dct].
+    [luma] must match the mode used by encode_watermark.
+    [decoder] are the threads of the decoder (see open_existing_movie)
     """
-    decoded = BitArray()
+    return decode_AB_multi([key], n_dct, movie_filename, freq, luma, legacy, queue_depth, workers, decoder)[0]
 
-    G = compute_G(key, n_dct)
-    video_packets, audio_packets, video_stream, audio_stream = open_existing_movie(movie_filename)
+
+def decode_AB_multi(keys: list, n_dct: int, movie_filename: str, freq: float, luma: bool = False, legacy: bool = True,
+                    queue_depth: int = QUEUE_DEPTH, workers: int = None, decoder: dict = None) -> list:
+    """
+    Same as decode_AB for each key of [keys], with a single decoding of [movie_filename] :
+    the watermarks of all keys are stacked in a matrix, so that the correlations
+    with every key are given by one matrix product per batch of frames (see BatchCorrelator).
+    Decoding and correlating (by [workers] threads) run in parallel (see run_pipeline).
+    Returns the (message, confidence) of each key
+    """
+    G = np.stack([compute_G(key, n_dct, legacy) for key in keys])
+    correlator = BatchCorrelator(G, n_dct, luma)
+    container, video_stream, audio_stream = open_existing_movie(movie_filename, **(decoder or {}))
 
     fps = video_stream.average_rate
 
     skip_frames = int(fps / freq)
-    frames = 0
-    c = 0 # sum of correlations
-    avg_c = 0
-    c_count = 0
+    n_bits = 0
+    c = {} # sums of correlations for each bit period
+
+    def decode(bar):
+        # Decoded frames, with the index of their bit period
+        nonlocal n_bits
+        frames = 0
+        # Audio is not needed
+        for frame in decode_frames(PacketIterator(container, video_stream, bar=bar), video_stream):
+            frames = (frames+1) % skip_frames
+
+            # The last frame of each bit period is not used
+            if frames == 0:
+                n_bits += 1
+                continue
+
+            yield n_bits, frame
 
-    with alive_bar(len(video_packets)) as bar:
-        video_iterator = VideoIterator(video_packets, audio_packets, bar=bar)
+    def add_correlations(correlations):
+        for bit_index, c_frame in correlations:
+            c[bit_index] = c.get(bit_index, 0) + c_frame
 
-        for video_packet, audio_packet in iter(video_iterator):
-            if (video_packet is None) or ((audio_packet is not None) and (audio_packet.dts < video_packet.dts)):
+    try:
+        with alive_bar(count_frames(video_stream)) as bar:
+            run_pipeline(batched(decode(bar), correlator.batch_size), correlator.correlate_tagged, add_correlations, queue_depth, workers)
+    finally:
+        container.close()
+
+    # Only complete bit periods are decoded
+    c = np.array([c.get(i, np.zeros(len(keys))) for i in range(n_bits)]).reshape(n_bits, len(keys))
+    return [(correlations_to_message(c_key), correlations_to_confidence(c_key)) for c_key in c.T]
+
+
+def decode_AB_incremental(key: int, n_dct: int, movie_filename: str, freq: float, message_bits: int, luma: bool = False, legacy: bool = True,
+                          margin: float = DECODE_MARGIN, checksum: bool = False, report: Callable = None,
+                          queue_depth: int = QUEUE_DEPTH, workers: int = None, decoder: dict = None) -> tuple:
+    """
+    Same as decode_AB for a message of [message_bits] bits repeated until the end of [movie_filename] (see encode_AB),
+    stopping as soon as the message is known : the correlations of each bit period are accumulated on the position
+    of the bit in the message. The confidence of a bit is the t-statistic of its correlations over the repetitions
+    (the mean divided by its standard error), the variance of the noise being pooled over every position :
+    with a few repetitions, the spread of the correlations of a single bit says little about the noise.
+    Decoding stops once every bit has a confidence of at least [margin]
+    and, if [checksum], once the checksum of the message is right (see message_to_bytes).
+    [report] is called with the running (message, confidences, repetitions) after each repetition of the message.
+    Returns the (message, confidences of each bit of the message, number of bit periods decoded)
+    """
+    correlator = BatchCorrelator(compute_G(key, n_dct, legacy)[np.newaxis], n_dct, luma)
+    container, video_stream, audio_stream = open_existing_movie(movie_filename, **(decoder or {}))
+
+    skip_frames = int(video_stream.average_rate / freq)
+    c = {} # sums of correlations for each bit period being decoded
+    n_bits = 0 # complete bit periods
+    # Over the repetitions, for each position in the message : number of bit periods, sums of correlations and of their squares
+    c_count = np.zeros(message_bits)
+    c_sum = np.zeros(message_bits)
+    c_sum_sq = np.zeros(message_bits)
+
+    def estimate():
+        mean = c_sum / np.maximum(c_count, 1)
+        # Pooled over the positions (rounding errors may make it slightly negative)
+        variance = max(np.sum(c_sum_sq - c_count * mean**2), 0) / max(np.sum(np.maximum(c_count - 1, 0)), 1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            confidences = np.nan_to_num(np.abs(mean) * np.sqrt(c_count / variance))
+        # No spread of the correlations with less than 2 repetitions
+        confidences[c_count < 2] = 0
+        # The bits of the message are in the reverse order of the bit periods (see correlations_to_message)
+        return correlations_to_message(mean), confidences[::-1], int(c_count.min())
+
+    def decode(bar):
+        # Decoded frames, with the index of their bit period
+        frames = 0
+        bit_index = 0
+        for frame in decode_frames(PacketIterator(container, video_stream, bar=bar), video_stream):
+            frames = (frames+1) % skip_frames
+
+            # The last frame of each bit period is not used
+            if frames == 0:
+                bit_index += 1
                 continue
 
-            for frame in video_packet.decode():
-                frames = (frames+1) % skip_frames
+            yield bit_index, frame
 
-                if frames == 0:
-                    avg_c += c
-                    c_count += 1
-                    decoded.append(Bits('0b1' if c<=0 else '0b0'))
-                    c = 0
-                    continue
+    def add_correlations(correlations):
+        nonlocal n_bits
+        for bit_index, c_frame in correlations:
+            # The frames come in order : the previous bit periods are complete
+            while n_bits < bit_index:
+                c_bit = c.pop(n_bits, 0)
+                c_count[n_bits % message_bits] += 1
+                c_sum[n_bits % message_bits] += c_bit
+                c_sum_sq[n_bits % message_bits] += c_bit**2
+                n_bits += 1
+
+                if n_bits % message_bits == 0:
+                    message, confidences, repetitions = estimate()
+                    if report:
+                        report(message, confidences, repetitions)
+                    if confidences.min() >= margin and (not checksum or bytes_to_message(message.bytes, checksum=True) is not None):
+                        return True
+
+            c[bit_index] = c.get(bit_index, 0) + c_frame[0]
+
+    with alive_bar(count_frames(video_stream)) as bar:
+        run_pipeline(batched(decode(bar), correlator.batch_size), correlator.correlate_tagged, add_correlations, queue_depth, workers)
+
+    container.close()
+    message, confidences = estimate()[:2]
+    return message, confidences, n_bits
+
+
+def get_frame_index(frame, video_stream) -> int:
+    """
+    Returns the index of [frame] in [video_stream] (in presentation order), from its timestamp
+    """
+    return round((frame.pts - (video_stream.start_time or 0)) * video_stream.time_base * video_stream.average_rate)
+
+
+def sample_frames(container, video_stream, skip_frames: int, step: int = 1, frames_per_bit: int = None):
+    """
+    Yields the (index, frame) of every [step]-th decoded frame of each bit period of [skip_frames] frames.
+    If [frames_per_bit] is given, only the first [frames_per_bit] of these frames are decoded in each
+    bit period : the decoder seeks directly to the keyframe before the next period
+    """
+    if frames_per_bit is None:
+        for frame in profiled('decode', container.decode(video_stream), frames=True):
+            frame_index = get_frame_index(frame, video_stream)
+            if (frame_index % skip_frames) % step == 0:
+                yield frame_index, frame
+        return
+
+    fps = video_stream.average_rate
+    bit_index = 0
+    while True:
+        period_start = bit_index * skip_frames
+        container.seek((video_stream.start_time or 0) + int(period_start / fps / video_stream.time_base), stream=video_stream)
+        samples = 0
+
+        for frame in profiled('decode', container.decode(video_stream), frames=True):
+            frame_index = get_frame_index(frame, video_stream)
+            if frame_index < period_start or (frame_index - period_start) % step:
+                continue
+            if frame_index >= period_start + skip_frames or samples == frames_per_bit:
+                break
+
+            yield frame_index, frame
+            samples += 1
+
+        else: # End of the video
+            return
 
-                image = frame.to_image()
-                array = np.array(image)
+        bit_index += 1
 
-                array_dct = cv2.dct(array[:,:,CHANNEL]/255)
-                middle_slice = get_middle_coefs_slice(array_dct, n_dct)
-                c += np.dot(G, middle_slice.flatten())
 
-    return decoded[::-1], avg_c/c_count
+def decode_AB_sampled(keys: list, n_dct: int, movie_filename: str, freq: float, luma: bool = False,
+                      step: int = 1, frames_per_bit: int = None, skip_frame: str = None, legacy: bool = True,
+                      queue_depth: int = QUEUE_DEPTH, workers: int = None, decoder: dict = None) -> list:
+    """
+    Same as decode_AB_multi, but only a subset of the frames of each bit period is used (see sample_frames).
+    [skip_frame] is passed to the decoder to avoid decoding some frames at all
+    ('NONKEY' to decode only the keyframes, 'NONREF' to skip frames which are not references).
+    The confidence is scaled to the number of frames per bit period, so that it can be compared with decode_AB
+    """
+    G = np.stack([compute_G(key, n_dct, legacy) for key in keys])
+    correlator = BatchCorrelator(G, n_dct, luma)
+    container, video_stream, audio_stream = open_existing_movie(movie_filename, **(decoder or {}))
+
+    if skip_frame is not None:
+        video_stream.codec_context.skip_frame = skip_frame
+
+    skip_frames = int(video_stream.average_rate / freq)
+    c = {} # sums of correlations for each bit period
+    samples = {} # number of frames used for each bit period
+
+    def add_correlations(correlations):
+        for bit_index, c_frame in correlations:
+            c[bit_index] = c.get(bit_index, 0) + c_frame
+            samples[bit_index] = samples.get(bit_index, 0) + 1
+
+    def decode(bar):
+        for frame_index, frame in sample_frames(container, video_stream, skip_frames, step, frames_per_bit):
+            yield frame_index // skip_frames, frame
+            bar()
+
+    try:
+        with alive_bar() as bar:
+            run_pipeline(batched(decode(bar), correlator.batch_size), correlator.correlate_tagged, add_correlations, queue_depth, workers)
+        n_frames = count_frames(video_stream)
+    finally:
+        container.close()
+
+    # Only complete bit periods are decoded, as in decode_AB
+    n_bits = n_frames // skip_frames if n_frames else max(c) + 1
+    # decode_AB sums the correlations of (skip_frames - 1) frames per bit period
+    c = np.array([c[i] * (skip_frames-1) / samples[i] if i in c else np.zeros(len(keys)) for i in range(n_bits)])
+
+    return [(correlations_to_message(c_key), correlations_to_confidence(c_key)) for c_key in c.T]
+
+
+def compare_sampling(key: int, n_dct: int, movie_filename: str, freq: float, luma: bool = False, legacy: bool = True, steps: list = (2, 4, 8, 16),
+                     queue_depth: int = QUEUE_DEPTH, workers: int = None, decoder: dict = None) -> list:
+    """
+    Measures the cost of sampling the frames in decode_AB_sampled : the correlation of every frame of [movie_filename]
+    is computed once, then the decoding is simulated for every [step]-th frame of [steps] and for keyframes only.
+    Returns a (sampling, message, confidence, number of bits differing from the decoding with all frames) for each sampling
+    """
+    correlator = BatchCorrelator(compute_G(key, n_dct, legacy)[None,:], n_dct, luma)
+    container, video_stream, audio_stream = open_existing_movie(movie_filename, **(decoder or {}))
+
+    skip_frames = int(video_stream.average_rate / freq)
+    frame_indexes = []
+    keyframes = []
+    correlations = []
+
+    def add_correlations(correlations_batch):
+        for (frame_index, keyframe), c_frame in correlations_batch:
+            frame_indexes.append(frame_index)
+            keyframes.append(keyframe)
+            correlations.append(c_frame[0])
+
+    def decode(bar):
+        for frame in profiled('decode', container.decode(video_stream), frames=True):
+            yield (get_frame_index(frame, video_stream), frame.key_frame), frame
+            bar()
+
+    try:
+        with alive_bar(count_frames(video_stream)) as bar:
+            run_pipeline(batched(decode(bar), correlator.batch_size), correlator.correlate_tagged, add_correlations, queue_depth, workers)
+    finally:
+        container.close()
+
+    frame_indexes = np.array(frame_indexes)
+    keyframes = np.array(keyframes, dtype=bool)
+    correlations = np.array(correlations)
+    bit_indexes = frame_indexes // skip_frames
+    n_bits = len(frame_indexes) // skip_frames
+
+    def decode_selection(selected):
+        # Same as decode_AB_sampled
+        selected = selected & (bit_indexes < n_bits)
+        c = np.bincount(bit_indexes[selected], correlations[selected], minlength=n_bits)
+        samples = np.bincount(bit_indexes[selected], minlength=n_bits)
+        c = np.where(samples > 0, c * (skip_frames-1) / np.maximum(samples, 1), 0)
+        return correlations_to_message(c), correlations_to_confidence(c)
+
+    samplings = [('all frames', np.ones(len(frame_indexes), dtype=bool))]
+    samplings += [('1/{} frames'.format(step), (frame_indexes % skip_frames) % step == 0) for step in steps]
+    samplings += [('keyframes', keyframes)]
+
+    results = []
+    reference = None
+    for sampling, selected in samplings:
+        message, confidence = decode_selection(selected)
+        reference = reference if reference is not None else message
+        results.append((sampling, message, confidence, (message ^ reference).count(1)))
+
+    return results
 
 
 if __name__ == '__main__':
@@ -295,7 +1711,7 @@ if __name__ == '__main__':
 
     parser.add_argument('action', choices=['w', 'e', 'd'], help='w (watermark)\ne (encode using A/B scheme)\nd (decode)')
 
-    parser.add_argument('-k', '--key', type=int, nargs=1)
+    parser.add_argument('-k', '--key', type=int, nargs='+', help='Secret key (several keys to decode with each of them)')
     parser.add_argument('-n', '--n-dct', type=int, nargs=1)
     parser.add_argument('-i', '--input', type=str, nargs='+', help='Input filename')
     parser.add_argument('-o', '--output', type=str, nargs=1, help='Output filename')
@@ -303,24 +1719,145 @@ if __name__ == '__main__':
     parser.add_argument('-a', '--alpha', type=float, nargs=1, help='Type of watermarking')
     parser.add_argument('-m', '--message', type=int, nargs=1, help='Message (ID) to hide')
     parser.add_argument('-f', '--frequency', type=float, nargs=1, help='Frequency of encoding')
+    parser.add_argument('-r', '--remux', action='store_true', help='A/B encoding by copying GOPs without re-encoding')
+    parser.add_argument('-b', '--batch', type=str, nargs=1, help='File with one message (ID) per line, - for stdin. The output must contain {} (replaced by the ID)')
+    parser.add_argument('--batch-size', type=int, default=64, help='Maximum number of outputs written at once in batch mode')
+    parser.add_argument('-l', '--luma', action='store_true', help='Watermark the luma plane instead of the RGB image')
+    parser.add_argument('--new-rng', action='store_true', help='Derive the watermark from the key with a numpy Generator (not compatible with the legacy patterns)')
+    parser.add_argument('-s', '--stream', action='store_true', help='Process a stream of segments : the inputs are directories of segments (or - for filenames on stdin), the output a directory')
+    parser.add_argument('--stream-timeout', type=float, help='End of a stream when no segment appears for this many seconds (default : wait for the END file)')
+    parser.add_argument('--repeat', action=argparse.BooleanOptionalAction, help='Repeat the message until the end of the video (default : only in a stream)')
+    parser.add_argument('--message-bytes', type=int, help='Fixed size of the message (in bytes, without the checksum) : decode by accumulating its repetitions, stopping once every bit is known')
+    parser.add_argument('--checksum', action='store_true', help='Append a checksum to the message, checked when decoding with --message-bytes')
+    parser.add_argument('--margin', type=float, default=DECODE_MARGIN, help='Minimum confidence of every bit to stop decoding with --message-bytes')
+    parser.add_argument('--step', type=int, default=1, help='Decode using only every step-th frame of each bit period')
+    parser.add_argument('--frames-per-bit', type=int, help='Decode only this many frames per bit period, seeking to the next period')
+    parser.add_argument('--skip-frame', choices=['NONREF', 'NONKEY'], help='Frames skipped by the video decoder when decoding')
+    parser.add_argument('--sampling-report', action='store_true', help='Compare the confidence of decoding with different samplings of the frames')
+    parser.add_argument('--queue-depth', type=int, default=QUEUE_DEPTH, help='Maximum number of packets or batches of frames waiting between decoding, processing and encoding')
+    parser.add_argument('--workers', type=int, help='Number of threads processing the decoded frames')
+    parser.add_argument('-p', '--processes', type=int, nargs='?', const=0, help='Watermark segments of the video in parallel with this many processes (default : one per CPU)')
+
+    parser.add_argument('--encoder-profile', choices=list(ENCODER_PROFILES), default='default', help='Encoder settings of the output (fast for A/B assembly, quality for masters)')
+    parser.add_argument('--master-profile', choices=list(ENCODER_PROFILES), default='default', help='Encoder settings of the masters computed by e from a single source video')
+    parser.add_argument('--encoder', type=str, help='Video encoder of the output (default : {})'.format(VIDEO_CODEC))
+    parser.add_argument('--preset', type=str, help='Preset of the video encoder (overrides the profile)')
+    parser.add_argument('--crf', type=float, help='Constant quality of the video encoder (overrides the profile)')
+    parser.add_argument('--bitrate', type=int, help='Bitrate of the video encoder, in bits/s (overrides the profile)')
+    parser.add_argument('--threads', type=int, help='Number of threads of the video encoder, 0 for one per CPU (overrides the profile)')
+    parser.add_argument('--thread-type', choices=['FRAME', 'SLICE'], help='Threading of the video encoder (overrides the profile)')
+    parser.add_argument('--lookahead', type=int, help='Number of frames of lookahead of the video encoder (overrides the profile)')
+    parser.add_argument('--decoder-threads', type=int, help='Number of threads of the video decoders, 0 for one per CPU')
+    parser.add_argument('--decoder-thread-type', choices=['AUTO', 'FRAME', 'SLICE'], help='Threading of the video decoders')
+    parser.add_argument('--cache', type=str, default=os.environ.get('NUTFLEX_CACHE'), metavar='DIR', help='Directory of the cache of watermarked masters (default : $NUTFLEX_CACHE)')
+    parser.add_argument('--cache-size', type=float, default=MASTER_CACHE_SIZE / 2**30, help='Maximum size of the cache of masters (in GiB)')
+    parser.add_argument('--profile', type=str, nargs='?', const='', metavar='FILE', help='Print the time spent in each stage, and write the metrics to FILE (Prometheus text if it ends with .prom, JSON otherwise)')
 
     args = parser.parse_args()
 
+    if args.profile is not None:
+        enable_profiling()
+
+    cache = MasterCache(args.cache, int(args.cache_size * 2**30)) if args.cache else None
+
+    encoder = encoder_profile(args.encoder_profile, codec=args.encoder, preset=args.preset, crf=args.crf, bitrate=args.bitrate,
+                              threads=args.threads, thread_type=args.thread_type, lookahead=args.lookahead)
+    decoder = {'thread_type': args.decoder_thread_type, 'thread_count': args.decoder_threads}
+
     if args.action == 'w':
-        if None in (args.type, args.key, args.n_dct, args.alpha, args.input, args.input, args.output) or len(args.input) != 1:
+        if None in (args.type, args.key, args.n_dct, args.alpha, args.input, args.input, args.output) or len(args.input) != 1 or len(args.key) != 1:
             parser.error('watermarking requires type, key, n-dct, alpha, input and output')
 
-        encode_watermark(args.type[0], args.key[0], args.n_dct[0], args.alpha[0], args.input[0], args.output[0])
+        if args.stream:
+            encode_watermark_stream(args.type[0], args.key[0], args.n_dct[0], args.alpha[0], args.input[0], args.output[0], luma=args.luma, legacy=not args.new_rng,
+                                    timeout=args.stream_timeout, queue_depth=args.queue_depth, workers=args.workers, encoder=encoder, decoder=decoder)
+        elif cache is not None:
+            shutil.copyfile(cache.get_master(args.type[0], args.key[0], args.n_dct[0], args.alpha[0], args.input[0], luma=args.luma, legacy=not args.new_rng,
+                                             processes=args.processes, encoder=encoder, decoder=decoder), args.output[0])
+        elif args.processes is not None:
+            encode_watermark_parallel(args.type[0], args.key[0], args.n_dct[0], args.alpha[0], args.input[0], args.output[0], luma=args.luma, legacy=not args.new_rng, processes=args.processes,
+                                      encoder=encoder, decoder=decoder)
+        else:
+            encode_watermark(args.type[0], args.key[0], args.n_dct[0], args.alpha[0], args.input[0], args.output[0], luma=args.luma, legacy=not args.new_rng,
+                             queue_depth=args.queue_depth, workers=args.workers, encoder=encoder, decoder=decoder)
 
-    if args.action == 'e':
+    if args.action == 'e' and args.stream:
+        if None in (args.message, args.input, args.output, args.frequency) or len(args.input) != 2:
+            parser.error('stream encoding requires message, 2 input streams A and B, output directory and an encoding frequency')
+        encode_AB_stream(message_to_bytes(args.message[0], args.message_bytes, args.checksum), args.input[0], args.input[1], args.output[0], args.frequency[0],
+                         repeat=args.repeat is not False, timeout=args.stream_timeout, queue_depth=args.queue_depth, encoder=encoder, decoder=decoder)
+
+    elif args.action == 'e' and args.input is not None and len(args.input) == 1:
+        # A and B masters of a source video, from the cache
+        if cache is None or None in (args.key, args.n_dct, args.alpha) or len(args.key) != 1:
+            parser.error('encoding from a single source video requires a cache of masters, key, n-dct and alpha')
+        master_encoder = encoder_profile(args.master_profile)
+        master_A = cache.get_master(0, args.key[0], args.n_dct[0], args.alpha[0], args.input[0], luma=args.luma, legacy=not args.new_rng,
+                                    processes=args.processes, encoder=master_encoder, decoder=decoder)
+        master_B = cache.get_master(1, args.key[0], args.n_dct[0], args.alpha[0], args.input[0], luma=args.luma, legacy=not args.new_rng,
+                                    processes=args.processes, in_use=(master_A,), encoder=master_encoder, decoder=decoder)
+        args.input = [master_A, master_B]
+
+    if args.action == 'e' and not args.stream and args.batch is not None:
+        if None in (args.input, args.output, args.frequency) or len(args.input) != 2 or '{}' not in args.output[0]:
+            parser.error('batch encoding requires 2 input video files A and B, an output pattern containing {} and an encoding frequency')
+
+        messages = read_messages(args.batch[0])
+        # Bound the number of files (and encoders) open at the same time
+        for i in range(0, len(messages), args.batch_size):
+            batch = messages[i:i+args.batch_size]
+            msgs = [message_to_bytes(message, args.message_bytes, args.checksum) for message in batch]
+            out_filenames = [args.output[0].format(message) for message in batch]
+            if args.remux:
+                remux_AB_batch(msgs, args.input[0], args.input[1], out_filenames, args.frequency[0], repeat=bool(args.repeat))
+            else:
+                encode_AB_batch(msgs, args.input[0], args.input[1], out_filenames, args.frequency[0], queue_depth=args.queue_depth, repeat=bool(args.repeat),
+                                encoder=encoder, decoder=decoder)
+
+    elif args.action == 'e' and not args.stream:
         if None in (args.message, args.input, args.output, args.frequency) or len(args.input) != 2:
             parser.error('encoding requires message, 2 input video files A and B, output and an encoding frequency')
-        encode_AB(args.message[0].to_bytes((args.message[0])+1), args.input[0], args.input[1], args.output[0], args.frequency[0])
+        msg = message_to_bytes(args.message[0], args.message_bytes, args.checksum)
+        if args.remux:
+            remux_AB(msg, args.input[0], args.input[1], args.output[0], args.frequency[0], repeat=bool(args.repeat))
+        else:
+            encode_AB(msg, args.input[0], args.input[1], args.output[0], args.frequency[0], queue_depth=args.queue_depth, repeat=bool(args.repeat),
+                      encoder=encoder, decoder=decoder)
 
     if args.action == 'd':
         if None in (args.key, args.n_dct, args.input, args.frequency) or len(args.input) != 1:
             parser.error('decoding requires key, n-dct, input and frequency')
 
-        res, quality = decode_AB(args.key[0], args.n_dct[0], args.input[0], args.frequency[0])
-        print("Decoded {} = {}  with confidence {}".format(res.b,res.u, quality))
-
+        if args.sampling_report:
+            for sampling, res, quality, errors in compare_sampling(args.key[0], args.n_dct[0], args.input[0], args.frequency[0], luma=args.luma, legacy=not args.new_rng,
+                                                                   queue_depth=args.queue_depth, workers=args.workers, decoder=decoder):
+                print("{} : decoded {} = {}  with confidence {} ({} bits differ)".format(sampling, res.b, res.u, quality, errors))
+        elif args.message_bytes is not None:
+            message_bits = 8 * (args.message_bytes + CHECKSUM_BYTES * args.checksum)
+
+            def report(res, confidences, repetitions):
+                print("{} repetitions : decoded {} = {}  with minimum confidence {}".format(repetitions, res.b, bytes_to_message(res.bytes, args.checksum), confidences.min()))
+
+            res, confidences, n_bits = decode_AB_incremental(args.key[0], args.n_dct[0], args.input[0], args.frequency[0], message_bits, luma=args.luma, legacy=not args.new_rng,
+                                                             margin=args.margin, checksum=args.checksum, report=report, queue_depth=args.queue_depth, workers=args.workers,
+                                                             decoder=decoder)
+            print("Decoded {} = {}  with minimum confidence {} after {} bits".format(res.b, bytes_to_message(res.bytes, args.checksum), confidences.min(), n_bits))
+        elif args.step != 1 or args.frames_per_bit is not None or args.skip_frame is not None:
+            for key, (res, quality) in zip(args.key, decode_AB_sampled(args.key, args.n_dct[0], args.input[0], args.frequency[0], luma=args.luma, legacy=not args.new_rng,
+                                                                       step=args.step, frames_per_bit=args.frames_per_bit, skip_frame=args.skip_frame,
+                                                                       queue_depth=args.queue_depth, workers=args.workers, decoder=decoder)):
+                print("Key {} : decoded {} = {}  with confidence {}".format(key, res.b, res.u, quality))
+        elif len(args.key) > 1:
+            for key, (res, quality) in zip(args.key, decode_AB_multi(args.key, args.n_dct[0], args.input[0], args.frequency[0], luma=args.luma, legacy=not args.new_rng,
+                                                                     queue_depth=args.queue_depth, workers=args.workers, decoder=decoder)):
+                print("Key {} : decoded {} = {}  with confidence {}".format(key, res.b, res.u, quality))
+        else:
+            res, quality = decode_AB(args.key[0], args.n_dct[0], args.input[0], args.frequency[0], luma=args.luma, legacy=not args.new_rng,
+                                     queue_depth=args.queue_depth, workers=args.workers, decoder=decoder)
+            print("Decoded {} = {}  with confidence {}".format(res.b,res.u, quality))
+
+    if PROFILER:
+        print(PROFILER.summary())
+        if args.profile:
+            with open(args.profile, 'w') as metrics_file:
+                metrics_file.write(PROFILER.to_prometheus() if args.profile.endswith('.prom') else PROFILER.to_json())
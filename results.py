@@ -0,0 +1,124 @@
+"""
+Typed columnar store of the experiment results
+@authors : micronoyau and devilsharu
+"""
+
+import os
+import io
+
+import numpy as np
+
+# Columns of the results, with their types.
+# message is the decoded message, truncated to its 64 lowest bits
+COLUMNS = {
+    'movie': 'U64',
+    'alpha': 'f8',
+    'n_dct': 'i4',
+    'encoding_time': 'f8',
+    'decoding_time': 'f8',
+    'message': 'u8',
+    'confidence': 'f8',
+    'compression': 'i4',
+}
+
+
+def resize_column(column_filename: str, length: int, values: np.array = None) -> None:
+    """
+    Resizes the 1D array saved in [column_filename] (.npy) to its first [length] values followed by [values] (if given),
+    without reading the existing values : only the header is rewritten, and the file is truncated
+    """
+    values = np.empty(0) if values is None else values
+
+    if not os.path.exists(column_filename):
+        np.save(column_filename, values)
+        return
+
+    with open(column_filename, 'r+b') as column_file:
+        version = np.lib.format.read_magic(column_file)
+        read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+        shape, fortran_order, dtype = read_header(column_file)
+        header_size = column_file.tell()
+        length = min(length, shape[0])
+
+        header = io.BytesIO()
+        np.lib.format.write_array_header_1_0(header, {'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False,
+                                                      'shape': (length + len(values),)})
+
+        # The header is padded so that the shape can change : otherwise, rewrite the whole file
+        if header.tell() != header_size:
+            column_file.close()
+            np.save(column_filename, np.concatenate([np.load(column_filename)[:length], values.astype(dtype)]))
+            return
+
+        # Values first, so that an interrupted append leaves a valid file
+        column_file.seek(header_size + length * dtype.itemsize)
+        column_file.write(values.astype(dtype).tobytes())
+        column_file.truncate()
+        column_file.seek(0)
+        column_file.write(header.getvalue())
+
+
+def append_to_column(column_filename: str, values: np.array) -> None:
+    """
+    Appends [values] at the end of the 1D array saved in [column_filename] (.npy),
+    without reading the existing values (see resize_column)
+    """
+    resize_column(column_filename, np.iinfo(np.int64).max, values)
+
+
+class ResultsStore:
+    """
+    Results saved in the directory [path], as one memory-mapped .npy file per column (see COLUMNS)
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+
+    def _column_filename(self, column: str) -> str:
+        return os.path.join(self.path, column + '.npy')
+
+
+    def __len__(self) -> int:
+        # An interrupted append may leave some columns longer than others
+        return min((len(np.load(self._column_filename(column), mmap_mode='r')) if os.path.exists(self._column_filename(column)) else 0)
+                   for column in COLUMNS)
+
+
+    def append(self, rows: list) -> None:
+        """
+        Appends [rows], each one being a tuple of the values of COLUMNS (in order)
+        """
+        if not rows:
+            return
+
+        # An interrupted append may leave some columns longer than others : every column restarts after the last complete row
+        n = len(self)
+        for column, values in zip(COLUMNS, zip(*rows)):
+            resize_column(self._column_filename(column), n, np.array(values, dtype=COLUMNS[column]))
+
+
+    def load(self, *columns) -> dict:
+        """
+        Returns the arrays of [columns] (all of them by default), memory-mapped : only the columns used are read
+        """
+        columns = columns or tuple(COLUMNS)
+        n = len(self)
+        if n == 0:
+            return {column: np.empty(0, dtype=COLUMNS[column]) for column in columns}
+        return {column: np.load(self._column_filename(column), mmap_mode='r')[:n] for column in columns}
+
+
+    def import_text(self, text_filename: str) -> None:
+        """
+        Appends the results of a text file written by the previous versions of experiment.py
+        (one result per line, with the values of COLUMNS separated by spaces)
+        """
+        rows = []
+        with open(text_filename) as text_file:
+            for line in text_file:
+                l = line.split()
+                if len(l) == len(COLUMNS):
+                    rows.append((l[0], float(l[1]), int(l[2]), float(l[3]), float(l[4]), int(l[5]) % 2**64, float(l[6]), int(l[7])))
+        self.append(rows)
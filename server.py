@@ -0,0 +1,357 @@
+"""
+Long-running service serving encoding and decoding jobs, with the masters and the watermarks kept in memory
+@authors : micronoyau and devilsharu
+"""
+
+import os
+import time
+import json
+import socket
+import asyncio
+import itertools
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import av
+from alive_progress import config_handler
+
+from main import *
+
+# Default path of the Unix socket of the service
+SOCKET_PATH = 'nutflex.sock'
+
+# Number of finished jobs whose status is kept
+JOB_HISTORY = 1000
+
+# Number of packet indexes (and open masters) kept by the service
+INDEX_CACHE_SIZE = 64
+
+# Entries of a PacketIndex
+PACKET_INDEX_DTYPE = np.dtype([('stream', 'i4'), ('pos', 'i8'), ('size', 'i8'), ('pts', 'i8'), ('dts', 'i8'), ('duration', 'i8'), ('keyframe', '?')])
+
+
+class PacketIndex:
+    """
+    Index of the packets of the master [movie_filename] (an MP4 file, as written by encode_watermark), in dts order :
+    position in the file, size, timestamps and keyframe flag of each packet.
+    The container stays open (its streams are the templates of the outputs), and the packets are read back
+    directly from the file, without demuxing
+    """
+
+    def __init__(self, movie_filename: str):
+        self.movie_filename = movie_filename
+        self.mtime = os.path.getmtime(movie_filename)
+        self.container, self.video_stream, self.audio_stream = open_existing_movie(movie_filename)
+        self.streams = {stream.index: stream for stream in (self.video_stream, self.audio_stream)}
+
+        entries = []
+        for packet in PacketIterator(self.container, self.video_stream, self.audio_stream):
+            entries.append((packet.stream.index, packet.pos, packet.size, packet.pts, packet.dts, packet.duration or 0, packet.is_keyframe))
+            # The position is the one of the data of the packet in MP4 files only
+            if len(entries) == 1:
+                with open(movie_filename, 'rb') as movie_file:
+                    movie_file.seek(packet.pos)
+                    if packet.pos < 0 or movie_file.read(packet.size) != bytes(packet):
+                        raise ValueError("the packets of {} cannot be indexed".format(movie_filename))
+        self.packets = np.array(entries, dtype=PACKET_INDEX_DTYPE)
+
+        self.frames = int(np.count_nonzero(self.packets['stream'] == self.video_stream.index))
+
+        self.users = 0 # Jobs using the index (see Server.use_index)
+        self.evicted = False
+
+
+    def close(self) -> None:
+        self.container.close()
+
+
+    def __iter__(self):
+        """
+        Yields the packets of the master, read from the file
+        """
+        with open(self.movie_filename, 'rb') as movie_file:
+            for stream_index, pos, size, pts, dts, duration, keyframe in self.packets.tolist():
+                movie_file.seek(pos)
+                packet = av.Packet(movie_file.read(size))
+                stream = self.streams[stream_index]
+                packet.stream = stream
+                packet.time_base = stream.time_base
+                packet.pts, packet.dts, packet.duration = pts, dts, duration
+                packet.is_keyframe = keyframe
+                yield packet
+
+
+class Server:
+    """
+    Runs the jobs submitted by the clients (see handle_client) with [workers] jobs at a time (by default, one per CPU),
+    in the order of submission. The packet indexes of the masters (see PacketIndex) and the watermarks (see compute_G)
+    are kept from one job to the next, as well as the masters computed in the MasterCache [cache] if given
+    """
+
+    def __init__(self, workers: int = None, cache: MasterCache = None):
+        self.workers = workers or os.cpu_count()
+        self.cache = cache
+        self.executor = ThreadPoolExecutor(self.workers)
+        self.queue = None
+        self.jobs = {}
+        self.done = {} # Event of each job, set once it is finished
+        self.ids = itertools.count(1)
+        self.indexes = OrderedDict() # Least recently used first
+        self.index_locks = {} # Lock of each master, held while its index is built
+        self.lock = threading.Lock()
+
+
+    @contextmanager
+    def use_index(self, movie_filename: str):
+        """
+        Gives the packet index of the master [movie_filename], built on first use (and again if the file changed).
+        At most INDEX_CACHE_SIZE indexes are kept : the least recently used ones are closed once no job uses them.
+        An index being built only blocks the jobs needing the same master
+        """
+        movie_filename = os.path.abspath(movie_filename)
+        with self.lock:
+            index_lock = self.index_locks.setdefault(movie_filename, threading.Lock())
+
+        with index_lock:
+            with self.lock:
+                index = self.indexes.get(movie_filename)
+            if index is None or index.mtime != os.path.getmtime(movie_filename):
+                index = PacketIndex(movie_filename)
+
+            with self.lock:
+                index.users += 1
+                old_index = self.indexes.pop(movie_filename, None)
+                self.indexes[movie_filename] = index
+                evicted = [self.indexes.popitem(last=False)[1] for i in range(len(self.indexes) - INDEX_CACHE_SIZE)]
+                if old_index not in (None, index):
+                    evicted.append(old_index)
+            for old in evicted:
+                self.release_index(old, evict=True)
+
+        try:
+            yield index
+        finally:
+            self.release_index(index)
+
+
+    def release_index(self, index: PacketIndex, evict: bool = False) -> None:
+        """
+        Closes [index] once it is no longer in the cache (evicted if [evict]) and no job uses it
+        """
+        with self.lock:
+            if evict:
+                index.evicted = True
+            else:
+                index.users -= 1
+            close = index.evicted and index.users == 0
+        if close:
+            index.close()
+
+
+    def get_masters(self, request: dict) -> list:
+        """
+        Returns the A and B masters of [request] : its 2 inputs, or the masters of its source video from the cache
+        """
+        if len(request['input']) == 2:
+            return request['input']
+        if self.cache is None:
+            raise ValueError("encoding from a single source video requires a cache of masters")
+
+        parameters = (request['key'], request['n_dct'], request['alpha'], request['input'][0])
+        options = {'luma': request.get('luma', False), 'legacy': request.get('legacy', True),
+                   'encoder': encoder_profile(request.get('master_profile', 'default'))}
+        master_A = self.cache.get_master(0, *parameters, **options)
+        return [master_A, self.cache.get_master(1, *parameters, in_use=(master_A,), **options)]
+
+
+    def encode(self, request: dict) -> dict:
+        """
+        Encodes the message of [request] (see encode_AB). With 'remux', whole GOPs are copied from the packet indexes of the masters
+        """
+        master_A, master_B = self.get_masters(request)
+        msg = message_to_bytes(request['message'], request.get('message_bytes'), request.get('checksum', False))
+
+        if request.get('remux', False):
+            with self.use_index(master_A) as index_A, self.use_index(master_B) as index_B:
+                assert index_A.frames == index_B.frames
+                fps = index_A.video_stream.average_rate
+                assert fps == index_B.video_stream.average_rate
+                remux_AB_packets([msg], index_A, index_B, index_A.video_stream, index_A.audio_stream, [request['output']],
+                                 fps / request['frequency'], request.get('repeat', False))
+        else:
+            encode_AB(msg, master_A, master_B, request['output'], request['frequency'], repeat=request.get('repeat', False),
+                      encoder=encoder_profile(request.get('encoder_profile', 'default')))
+
+        return {'output': request['output']}
+
+
+    def decode(self, request: dict) -> dict:
+        """
+        Decodes the message of [request] with each of its keys (see decode_AB_multi),
+        or incrementally with a single key if 'message_bytes' is given (see decode_AB_incremental)
+        """
+        keys = request['key'] if isinstance(request['key'], list) else [request['key']]
+        luma, legacy = request.get('luma', False), request.get('legacy', True)
+
+        if request.get('message_bytes') is not None:
+            checksum = request.get('checksum', False)
+            message_bits = 8 * (request['message_bytes'] + CHECKSUM_BYTES * checksum)
+            res, confidences, n_bits = decode_AB_incremental(keys[0], request['n_dct'], request['input'], request['frequency'], message_bits,
+                                                             luma, legacy, request.get('margin', DECODE_MARGIN), checksum)
+            return {'bits': res.b, 'message': bytes_to_message(res.bytes, checksum), 'confidences': confidences.tolist(), 'n_bits': n_bits}
+
+        results = decode_AB_multi(keys, request['n_dct'], request['input'], request['frequency'], luma, legacy)
+        return {'results': [{'key': key, 'bits': res.b, 'message': res.u, 'confidence': float(confidence)}
+                            for key, (res, confidence) in zip(keys, results)]}
+
+
+    def submit(self, request: dict) -> dict:
+        """
+        Queues the job [request] ('encode' or 'decode') and returns its status.
+        Its files must be given by absolute paths, since the service does not run in the directory of the client
+        """
+        filenames = request.get('input', [])
+        filenames = ([filenames] if isinstance(filenames, str) else filenames) + [request.get('output', '/')]
+        if not all(os.path.isabs(filename) for filename in filenames):
+            raise ValueError("the input and output files must be absolute paths")
+
+        job = {'id': next(self.ids), 'op': request['op'], 'state': 'queued', 'submitted': time.time(),
+               'started': None, 'finished': None, 'result': None, 'error': None}
+        self.jobs[job['id']] = job
+        self.done[job['id']] = asyncio.Event()
+        self.queue.put_nowait((job, request))
+        return job
+
+
+    async def worker(self) -> None:
+        """
+        Runs the queued jobs one after the other
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            job, request = await self.queue.get()
+            job['state'], job['started'] = 'running', time.time()
+            try:
+                job['result'] = await loop.run_in_executor(self.executor, getattr(self, request['op']), request)
+                job['state'] = 'done'
+            except Exception as error:
+                job['state'], job['error'] = 'failed', '{}: {}'.format(type(error).__name__, error)
+            job['finished'] = time.time()
+            self.done[job['id']].set()
+            self.forget()
+
+
+    def forget(self) -> None:
+        """
+        Removes the oldest finished jobs, so that at most JOB_HISTORY are kept
+        """
+        finished = [job_id for job_id, job in self.jobs.items() if job['finished'] is not None]
+        for job_id in finished[:max(0, len(finished) - JOB_HISTORY)]:
+            del self.jobs[job_id]
+            del self.done[job_id]
+
+
+    async def handle(self, request: dict) -> dict:
+        """
+        Returns the reply to [request] :
+        'encode' and 'decode' submit a job and return its status, 'status' returns the status of the job 'id',
+        'wait' waits for the job 'id' to finish and returns its status, 'jobs' returns the status of every job
+        """
+        if not isinstance(request, dict):
+            return {'error': 'a request is a JSON object'}
+        op = request.get('op')
+        if op in ('encode', 'decode'):
+            return self.submit(request)
+        if op == 'jobs':
+            return {'jobs': list(self.jobs.values())}
+        if op in ('status', 'wait'):
+            if request.get('id') not in self.jobs:
+                return {'error': 'unknown job {}'.format(request.get('id'))}
+            if op == 'wait':
+                await self.done[request['id']].wait()
+            return self.jobs[request['id']]
+        return {'error': 'unknown op {}'.format(op)}
+
+
+    async def handle_client(self, reader, writer) -> None:
+        """
+        Replies to the requests of a client : one JSON object per line, each reply being one JSON object per line
+        """
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    reply = await self.handle(json.loads(line))
+                except (ValueError, KeyError, TypeError) as error:
+                    reply = {'error': '{}: {}'.format(type(error).__name__, error)}
+                writer.write(json.dumps(reply).encode() + b'\n')
+                await writer.drain()
+        finally:
+            writer.close()
+
+
+    async def serve(self, socket_path: str = SOCKET_PATH, port: int = None) -> None:
+        """
+        Serves the clients on the Unix socket [socket_path], or on localhost:[port] if given
+        """
+        self.queue = asyncio.Queue()
+        workers = [asyncio.create_task(self.worker()) for i in range(self.workers)]
+
+        if port is not None:
+            server = await asyncio.start_server(self.handle_client, '127.0.0.1', port)
+        else:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            server = await asyncio.start_unix_server(self.handle_client, socket_path)
+
+        async with server:
+            await server.serve_forever()
+
+
+def request(request: dict, socket_path: str = SOCKET_PATH, port: int = None) -> dict:
+    """
+    Sends [request] to the service (see Server.handle) and returns its reply.
+    The input and output files are sent as absolute paths
+    """
+    request = dict(request)
+    if isinstance(request.get('input'), str):
+        request['input'] = os.path.abspath(request['input'])
+    elif 'input' in request:
+        request['input'] = [os.path.abspath(filename) for filename in request['input']]
+    if 'output' in request:
+        request['output'] = os.path.abspath(request['output'])
+
+    if port is not None:
+        client = socket.create_connection(('127.0.0.1', port))
+    else:
+        client = socket.socket(socket.AF_UNIX)
+        client.connect(socket_path)
+
+    with client, client.makefile('rwb') as stream:
+        stream.write(json.dumps(request).encode() + b'\n')
+        stream.flush()
+        return json.loads(stream.readline())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve encoding and decoding jobs, keeping the masters and the watermarks in memory')
+    parser.add_argument('-s', '--socket', type=str, default=SOCKET_PATH, help='Path of the Unix socket')
+    parser.add_argument('--port', type=int, help='Listen on this port of localhost instead of the Unix socket')
+    parser.add_argument('-w', '--workers', type=int, help='Number of jobs run at the same time (default : one per CPU)')
+    parser.add_argument('--cache', type=str, default=os.environ.get('NUTFLEX_CACHE'), metavar='DIR', help='Directory of the cache of watermarked masters (default : $NUTFLEX_CACHE)')
+    parser.add_argument('--cache-size', type=float, default=MASTER_CACHE_SIZE / 2**30, help='Maximum size of the cache of masters (in GiB)')
+    parser.add_argument('-r', '--request', type=str, help='Send this request (JSON) to the running service and print its reply, instead of serving')
+    args = parser.parse_args()
+
+    if args.request is not None:
+        print(json.dumps(request(json.loads(args.request), args.socket, args.port)))
+    else:
+        # Jobs run concurrently : no progress bars
+        config_handler.set_global(disable=True)
+        cache = MasterCache(args.cache, int(args.cache_size * 2**30)) if args.cache else None
+        asyncio.run(Server(args.workers, cache).serve(args.socket, args.port))
@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+
+from main import get_middle_coefs_pattern
+
+
+def dct_matrix(size):
+    # Orthonormal DCT-II matrix of size [size], from its definition
+    k, n = np.meshgrid(np.arange(size), np.arange(size), indexing='ij')
+    D = np.cos(np.pi * (2*n + 1) * k / (2*size)) * np.sqrt(2 / size)
+    D[0] /= np.sqrt(2)
+    return D
+
+
+def middle_slice(array_dct, n_dct):
+    # Middle coefficients, as selected by the original implementation
+    midx, midy = array_dct.shape[0]//2, array_dct.shape[1]//2
+    return array_dct[midx-(n_dct//2):midx+(n_dct - n_dct//2), midy-(n_dct//2):midy+(n_dct - n_dct//2)]
+
+
+@pytest.mark.parametrize('shape', [(36, 64), (45, 71)])
+@pytest.mark.parametrize('n_dct', [4, 7])
+def test_middle_coefs_pattern(shape, n_dct):
+    rng = np.random.default_rng(0)
+    array = rng.uniform(0, 255, shape)
+    w = rng.normal(size=(n_dct, n_dct))
+    D_rows, D_cols = dct_matrix(shape[0]), dct_matrix(shape[1])
+    assert np.allclose(D_rows @ D_rows.T, np.eye(shape[0]))
+
+    pattern = get_middle_coefs_pattern(shape, w)
+
+    # The projection on the pattern is the correlation of w with the middle coefficients of the full DCT
+    full_dct = D_rows @ array @ D_cols.T
+    assert np.isclose(np.sum(array * pattern), np.sum(w * middle_slice(full_dct, n_dct)))
+
+    # Adding the pattern adds w to the middle coefficients, and leaves the others untouched
+    expected_dct = full_dct.copy()
+    middle_slice(expected_dct, n_dct)[...] += w
+    assert np.allclose(D_rows @ (array + pattern) @ D_cols.T, expected_dct)
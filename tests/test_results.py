@@ -0,0 +1,33 @@
+import numpy as np
+
+from results import COLUMNS, ResultsStore, append_to_column
+
+
+def row(i):
+    return ('movie{}.mp4'.format(i), 0.1 * i, i, 1.0, 2.0, i, 0.5, 0)
+
+
+def test_append_load(tmp_path):
+    store = ResultsStore(str(tmp_path))
+    store.append([row(0), row(1)])
+    store.append([row(2)])
+    assert len(store) == 3
+    assert store.load('n_dct')['n_dct'].tolist() == [0, 1, 2]
+
+
+def test_interrupted_append(tmp_path):
+    store = ResultsStore(str(tmp_path))
+    store.append([row(0)])
+
+    # Crash after the first columns of an append were written
+    for column in list(COLUMNS)[:3]:
+        append_to_column(store._column_filename(column), np.array([row(1)[list(COLUMNS).index(column)]], dtype=COLUMNS[column]))
+    assert len(store) == 1
+
+    store.append([row(2), row(3)])
+    assert len(store) == 3
+    results = store.load()
+    for i, expected in enumerate((row(0), row(2), row(3))):
+        assert tuple(results[column][i].item() for column in COLUMNS) == expected
+    for column in COLUMNS:
+        assert len(np.load(store._column_filename(column))) == 3
@@ -0,0 +1,41 @@
+import os
+
+import numpy as np
+import pytest
+
+from main import *
+from benchmark import generate_clip
+
+
+@pytest.fixture(scope='module')
+def clip(tmp_path_factory):
+    filename = str(tmp_path_factory.mktemp('clip') / 'clip.mp4')
+    generate_clip(filename, 320, 180, 4, GOP_SIZE)
+    return filename
+
+
+@pytest.mark.parametrize('luma', [False, True])
+def test_correlation_sign(clip, tmp_path, luma):
+    # The correlation of a frame watermarked with a 1 is positive, in both modes (see correlations_to_message)
+    correlator = BatchCorrelator(compute_G(42, 10)[np.newaxis], 10, luma)
+    for symbol in (0, 1):
+        master = str(tmp_path / '{}.mp4'.format(symbol))
+        encode_watermark(symbol, 42, 10, 4, clip, master, luma=luma)
+        container, video_stream, audio_stream = open_existing_movie(master)
+        c = np.concatenate([correlator(frames)[:, 0] for frames in batched(container.decode(video_stream), correlator.batch_size)])
+        container.close()
+        assert np.all(c > 0) if symbol else np.all(c < 0)
+
+
+@pytest.mark.parametrize('luma', [False, True])
+def test_decode_AB(clip, tmp_path, luma):
+    masters = [str(tmp_path / '{}.mp4'.format(symbol)) for symbol in (0, 1)]
+    for symbol, master in enumerate(masters):
+        encode_watermark(symbol, 42, 10, 4, clip, master, luma=luma)
+    out = str(tmp_path / 'ab.mp4')
+    encode_AB(message_to_bytes(5), *masters, out, 2)
+
+    res, confidence = decode_AB(42, 10, out, 2, luma=luma)
+    assert res.u == 5
+    # Mostly 0 bits
+    assert confidence > 0